@@ -0,0 +1,190 @@
+import sys
+import re
+import json
+import timeit
+import xml.dom.minidom as minidom
+from StringIO import StringIO
+from copy import copy
+import lighter.util as util
+
+def legacyMerge(aval, bval, path=''):
+    """
+    The util.merge implementation which copies every level of aval
+    """
+    aval = copy(aval)
+
+    if isinstance(aval, (list, tuple)) and isinstance(bval, (dict)):
+        aval = util.toList(aval)
+        for key, value in bval.items():
+            if int(key) < 0 or int(key) >= len(aval):
+                raise IndexError("The given list override index %s[%d] doesn't exist" % (path.lstrip('.'), int(key)))
+            aval[int(key)] = legacyMerge(aval[int(key)], value, '%s[%d]' % (path, int(key)))
+    elif isinstance(aval, dict) and isinstance(bval, dict):
+        for key in set(aval.keys() + bval.keys()):
+            aval[key] = legacyMerge(aval.get(key), bval.get(key), '%s.%s' % (path, key))
+    elif isinstance(aval, (list, tuple)) and isinstance(bval, (list, tuple)):
+        aval = util.toList(aval) + util.toList(bval)
+    elif bval is not None:
+        aval = bval
+
+    return aval
+
+def legacyReplace(template, variables, raiseError=True, escapeVar=True):
+    """
+    The util.replace implementation which copies the resolver for every string
+    """
+    result = copy(template)
+
+    if isinstance(result, dict):
+        for key, value in result.items():
+            result[key] = legacyReplace(value, variables, raiseError, escapeVar)
+    elif isinstance(result, (list, tuple)):
+        result = [legacyReplace(elem, variables, raiseError, escapeVar) for elem in result]
+    elif isinstance(result, (str, unicode)):
+        remaining = LegacyVariables(copy(variables))
+        replacements = 1
+
+        while replacements > 0 and isinstance(result, (str, unicode)):
+            replacements = 0
+            names = re.findall(r"(?<!%)%\{(\s*[\w\.]+\s*)\}", result)
+
+            if not names:
+                break
+            for name in set([name.strip() for name in names]):
+                try:
+                    value = remaining.pop(name)
+                    if result == '%%{%s}' % name:
+                        result = value
+                    else:
+                        result = re.sub('%{\s*' + re.escape(name) + '\s*}', unicode(value), result)
+                    replacements += 1
+                except KeyError:
+                    if raiseError:
+                        raise
+
+        if escapeVar and isinstance(result, (str, unicode)):
+            result = re.sub(r"%%\{(\s*[\w\.]+\s*)\}", "%{\\1}", result)
+
+    return result
+
+class LegacyVariables(object):
+    def __init__(self, variables):
+        self._variables = variables
+
+    def pop(self, name):
+        if name not in self._variables:
+            raise KeyError('Variable %%{%s} not found' % name)
+        return self._variables.pop(name)
+
+def benchmarkReplace():
+    variables = dict(('var%d' % i, 'value%d' % i) for i in range(500))
+    variables.update(dict(('ref%d' % i, '%%{other%d}-suffix' % i) for i in range(100)))
+    variables.update(dict(('other%d' % i, i) for i in range(100)))
+    template = {
+        'env': dict(('KEY%d' % i, 'prefix-%%{var%d}-%%{ref%d}-suffix' % (i % 500, i % 100)) for i in range(2000)),
+        'args': ['--flag-%d=%%{var%d}' % (i, i % 500) for i in range(2000)],
+        'labels': dict(('label%d' % i, 'static value %d' % i) for i in range(2000)),
+        'ports': [{'containerPort': i, 'servicePort': '%%{var%d}' % i} for i in range(100)],
+    }
+
+    expected = legacyReplace(template, variables)
+    if util.replace(template, util.FixedVariables(variables)) != expected:
+        raise RuntimeError('util.replace differs from the legacy implementation')
+
+    report('replace', [
+        ('legacy', lambda: legacyReplace(template, variables)),
+        ('util.replace', lambda: util.replace(template, util.FixedVariables(variables)))])
+
+def benchmarkMerge():
+    # Synthetic Marathon app template with 5000 keys spread over nested sections
+    template = {
+        'env': dict(('KEY%d' % i, 'value%d' % i) for i in range(2000)),
+        'labels': dict(('label%d' % i, 'value%d' % i) for i in range(2000)),
+        'container': {'docker': {
+            'image': 'meltwater/myservice:1.0.0',
+            'portMappings': [{'containerPort': i, 'servicePort': 0, 'protocol': 'tcp'} for i in range(100)],
+            'parameters': [{'key': 'label', 'value': 'value%d' % i} for i in range(100)]}},
+        'healthChecks': [{'path': '/health%d' % i, 'gracePeriodSeconds': 30} for i in range(100)],
+        'constraints': dict(('section%d' % i, dict(('key%d' % j, j) for j in range(10))) for i in range(80)),
+    }
+    override = {
+        'env': {'KEY1': 'override', 'NEWKEY': 'new'},
+        'container': {'docker': {'portMappings': {0: {'servicePort': 1234}}}},
+        'instances': 3,
+    }
+
+    # The key order is compared too since the config checksums depend on it
+    if json.dumps(util.merge(template, override)) != json.dumps(legacyMerge(template, override)):
+        raise RuntimeError('util.merge differs from the legacy implementation')
+
+    report('merge', [
+        ('legacy', lambda: legacyMerge(template, override)),
+        ('util.merge', lambda: util.merge(template, override)),
+        ('legacy (single key)', lambda: legacyMerge(template, {'instances': 3})),
+        ('util.merge (single key)', lambda: util.merge(template, {'instances': 3}))])
+
+def legacyXml(content):
+    """
+    The util.xmlRequest implementation which builds a minidom document
+    """
+    return legacyXmlTransform(minidom.parseString(content).documentElement)
+
+def legacyXmlText(nodelist):
+    result = ''
+    for node in nodelist:
+        if node.nodeType == node.TEXT_NODE:
+            result += node.data
+        else:
+            result += legacyXmlText(node.childNodes)
+    return result
+
+def legacyXmlTransform(node):
+    result = {}
+
+    for child in node.childNodes:
+        if child.nodeType != node.TEXT_NODE:
+            value = legacyXmlTransform(child)
+            item = result.get(child.tagName)
+            if item is None:
+                item = value
+            elif isinstance(item, list):
+                item.append(value)
+            else:
+                item = [item, value]
+            result[child.tagName] = item
+
+    return result or legacyXmlText(node.childNodes)
+
+def benchmarkXml():
+    # Synthetic maven-metadata.xml with 10000 versions
+    content = '<?xml version="1.0" encoding="UTF-8"?><metadata>' \
+        '<groupId>com.meltwater</groupId><artifactId>myservice</artifactId><versioning>' \
+        '<latest>99.99.0</latest><release>99.99.0</release><versions>%s</versions>' \
+        '<lastUpdated>20151102035120</lastUpdated></versioning></metadata>' % \
+        ''.join('<version>%d.%d.0</version>' % (i / 100, i % 100) for i in range(10000))
+    paths = ['versioning/versions/version', 'versioning/snapshot']
+
+    if util.xmlParse(StringIO(content)) != legacyXml(content):
+        raise RuntimeError('util.xmlParse differs from the legacy implementation')
+
+    report('xml', [
+        ('legacy', lambda: legacyXml(content)),
+        ('util.xmlParse', lambda: util.xmlParse(StringIO(content))),
+        ('util.xmlParse (paths)', lambda: util.xmlParse(StringIO(content), paths))])
+
+def report(name, candidates, number=5):
+    print '%s:' % name
+    for label, function in candidates:
+        elapsed = min(timeit.repeat(function, number=number, repeat=3)) / number
+        print '    %-24s %8.2f ms' % (label, elapsed * 1000)
+
+
+_benchmarks = {
+    'merge': benchmarkMerge,
+    'replace': benchmarkReplace,
+    'xml': benchmarkXml,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(_benchmarks.keys()):
+        _benchmarks[name]()
@@ -0,0 +1,173 @@
+import os
+import errno
+import logging
+import tempfile
+import threading
+
+_caches = []
+
+class MemoryCache(object):
+    """
+    Thread-safe in-memory cache which computes each value at most once, concurrent
+    lookups of a key that is being computed wait for the result of the first caller
+    """
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._pending = {}
+        _caches.append(self)
+
+    def get(self, key, factory):
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self.hits += 1
+                    return self._entries[key]
+
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+
+            # Another thread is computing this value, wait for it and look again
+            event.wait()
+
+        try:
+            value = factory()
+            with self._lock:
+                self._entries[key] = value
+            return value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskCache(object):
+    """
+    Directory of cached files which is kept below a maximum total size by evicting
+    the least recently used files. Files are replaced atomically so several threads
+    and processes may share the directory.
+    """
+    def __init__(self, name, path, maxsize):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._path = path
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self._size = sum(size for filename, size, mtime in self._entries())
+        _caches.append(self)
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as fd:
+                content = fd.read()
+        except IOError:
+            self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+
+        self.hits += 1
+        return content
+
+    def put(self, key, content):
+        fd, tmpname = tempfile.mkstemp(dir=self._path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmpfile:
+                tmpfile.write(content)
+            os.rename(tmpname, self._filename(key))
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+        with self._lock:
+            self._size += len(content)
+            if self._size > self._maxsize:
+                self._evict()
+
+    def remove(self, key):
+        try:
+            os.unlink(self._filename(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for filename, size, mtime in entries)
+
+        # Leave some headroom to avoid evicting on every write
+        for filename, size, mtime in entries:
+            if self._size <= self._maxsize * 0.9:
+                break
+            try:
+                os.unlink(filename)
+                self._size -= size
+                logging.debug('Evicted %s from cache %s', os.path.basename(filename), self.name)
+            except OSError:
+                pass
+
+    def _entries(self):
+        for name in os.listdir(self._path):
+            if name.startswith('.tmp-'):
+                continue
+            filename = os.path.join(self._path, name)
+            try:
+                stat = os.stat(filename)
+                yield filename, stat.st_size, stat.st_mtime
+            except OSError:
+                pass
+
+    def _filename(self, key):
+        return os.path.join(self._path, key)
+
+def statistics():
+    """
+    Returns the hits and misses of each cache in the order the caches were created, which
+    is the same in worker processes forked from this one
+    """
+    return [(cache.hits, cache.misses) for cache in _caches]
+
+def countedSince(before):
+    """
+    Returns the hits and misses of each cache counted since before was taken with statistics()
+    """
+    return [(hits - hits0, misses - misses0) for (hits, misses), (hits0, misses0) in zip(statistics(), before)]
+
+def addStatistics(counts):
+    """
+    Adds hits and misses counted by a worker process to the caches of this process
+    """
+    for cache, (hits, misses) in zip(_caches, counts):
+        cache.hits += hits
+        cache.misses += misses
+
+def logStatistics():
+    for cache in _caches:
+        if cache.hits or cache.misses:
+            logging.debug('Cache %s had %d hits and %d misses', cache.name, cache.hits, cache.misses)
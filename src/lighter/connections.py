@@ -0,0 +1,265 @@
+import io
+import sys
+import ssl
+import zlib
+import socket
+import httplib
+import urllib2
+import logging
+import threading
+
+# Methods that are safe to send on a connection the server may have closed in the meantime
+IDEMPOTENT_METHODS = set(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+
+# Compressed responses that are accepted and decoded, with the zlib window bits for each encoding
+_DECODERS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+_ACCEPT_ENCODING = 'gzip, deflate'
+_CHUNK_SIZE = 16 * 1024
+
+class ConnectionPool(object):
+    """
+    Idle keep-alive connections grouped by host, at most maxsize connections are kept
+    open for each host and any further connections are closed after use
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, key):
+        with self._lock:
+            connections = self._idle.get(key)
+            if connections:
+                return connections.pop()
+        return None
+
+    def release(self, key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxsize:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+class PooledResponse(object):
+    """
+    Reads the body of a response and hands the connection back to the pool once the body
+    has been read completely. A response closed before that also closes its connection.
+    """
+    def __init__(self, pool, key, connection, response):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+
+    def recv(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        # Responses without a body, like for HEAD requests, are done once read
+        if self._connection is not None and self._response.length == 0:
+            self._response.read()
+
+        if self._response.isclosed():
+            self._release()
+        elif self._connection is not None:
+            self._response.close()
+            self._connection.close()
+            self._connection = None
+
+    def _release(self):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            if self._response.will_close:
+                connection.close()
+            else:
+                self._pool.release(self._key, connection)
+
+class DecodingReader(io.RawIOBase):
+    """
+    Decompresses a gzip or deflate encoded body while it's being read
+    """
+    def __init__(self, fp, encoding):
+        self._fp = fp
+        self._encoding = encoding
+        self._decoder = zlib.decompressobj(_DECODERS[encoding])
+        self._started = False
+        self._buffer = ''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and self._decoder is not None:
+            chunk = self._fp.read(_CHUNK_SIZE)
+            if chunk:
+                self._buffer = self._decompress(chunk)
+            else:
+                self._buffer, self._decoder = self._decoder.flush(), None
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def _decompress(self, chunk):
+        try:
+            return self._decoder.decompress(chunk)
+        except zlib.error:
+            # Some servers send raw deflate data without the zlib header
+            if self._started or self._encoding != 'deflate':
+                raise
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(chunk)
+        finally:
+            self._started = True
+
+    def close(self):
+        if not self.closed:
+            self._fp.close()
+        io.RawIOBase.close(self)
+
+class KeepAliveHandler(object):
+    """
+    Sends requests on pooled connections instead of opening a new connection for each request
+    """
+    def __init__(self, pool):
+        self._pool = pool
+
+    def _open(self, http_class, req, **kwargs):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        tunnel = None
+        if req._tunnel_host:
+            tunnel = {}
+            if 'Proxy-Authorization' in headers:
+                # Proxy-Authorization should not be sent to origin server
+                tunnel['Proxy-Authorization'] = headers.pop('Proxy-Authorization')
+
+        key = (req.get_type(), host, req._tunnel_host)
+        response = None
+
+        connection = self._pool.acquire(key) if req.get_method() in IDEMPOTENT_METHODS else None
+        if connection is not None:
+            logging.debug('Reusing connection to %s', host)
+            try:
+                response = self._send(connection, req, headers)
+            except socket.timeout:
+                connection.close()
+                raise
+            except (socket.error, httplib.HTTPException, urllib2.URLError):
+                # The server closed the idle connection, try again on a new one
+                connection.close()
+                connection = None
+
+        if connection is None:
+            logging.debug('Opening connection to %s', host)
+            connection = http_class(host, timeout=req.timeout, **kwargs)
+            if tunnel is not None:
+                connection.set_tunnel(req._tunnel_host, headers=tunnel)
+            response = self._send(connection, req, headers)
+
+        fp = socket._fileobject(PooledResponse(self._pool, key, connection, response), close=True)
+        result = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        result.code = response.status
+        result.msg = response.reason
+        return result
+
+    def _send(self, connection, req, headers):
+        timeout = req.timeout if req.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT else socket.getdefaulttimeout()
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+
+        try:
+            connection.request(req.get_method(), req.get_selector(), req.data, headers)
+        except socket.error as e:
+            connection.close()
+            raise urllib2.URLError(e)
+
+        return connection.getresponse(buffering=True)
+
+class KeepAliveHTTPHandler(KeepAliveHandler, urllib2.HTTPHandler):
+    def __init__(self, pool):
+        KeepAliveHandler.__init__(self, pool)
+        urllib2.HTTPHandler.__init__(self)
+
+    def http_open(self, req):
+        return self._open(httplib.HTTPConnection, req)
+
+class KeepAliveHTTPSHandler(KeepAliveHandler, urllib2.HTTPSHandler):
+    def __init__(self, pool, context=None):
+        KeepAliveHandler.__init__(self, pool)
+        urllib2.HTTPSHandler.__init__(self, context=context)
+
+    def https_open(self, req):
+        return self._open(httplib.HTTPSConnection, req, context=self._context)
+
+
+# Idle connections kept open to each host, configured with --idle-connections
+_pool = ConnectionPool(8)
+_openers = {}
+_openersLock = threading.Lock()
+
+def openRequest(request, timeout=None, cafile=None):
+    """
+    Opens a request like urllib2.urlopen() but reusing the connections of earlier requests,
+    compressed responses are accepted unless the request asks otherwise and decoded on the fly
+    """
+    if request.get_type() in ('http', 'https') and not request.has_header('Accept-encoding'):
+        request.add_unredirected_header('Accept-Encoding', _ACCEPT_ENCODING)
+
+    try:
+        return decodeResponse(request, _openRequest(request, timeout, cafile))
+    except urllib2.HTTPError as e:
+        if e.fp is None or not _encoding(request, e.info()):
+            raise
+        raise urllib2.HTTPError(e.geturl(), e.code, e.msg, e.info(), decodeResponse(request, e)), None, sys.exc_info()[2]
+
+def decodeResponse(request, response):
+    """
+    Wraps a response to decompress its body if it is gzip or deflate encoded
+    """
+    encoding = _encoding(request, response.info())
+    if not encoding:
+        return response
+
+    fp = io.BufferedReader(DecodingReader(response, encoding), _CHUNK_SIZE)
+    return urllib2.addinfourl(fp, response.info(), response.geturl(), response.getcode())
+
+def _encoding(request, headers):
+    encoding = (headers.getheader('Content-Encoding') or '').strip().lower()
+    return encoding if encoding in _DECODERS and request.get_method() != 'HEAD' else None
+
+def _openRequest(request, timeout, cafile):
+    if not _pool.maxsize:
+        return urllib2.urlopen(request, cafile=cafile, timeout=timeout)
+
+    with _openersLock:
+        opener = _openers.get(cafile)
+        if opener is None:
+            context = ssl.create_default_context(cafile=cafile) if cafile else None
+            opener = _openers[cafile] = urllib2.build_opener(KeepAliveHTTPHandler(_pool), KeepAliveHTTPSHandler(_pool, context))
+
+    return opener.open(request, timeout=timeout)
+
+def enablePool(maxsize):
+    _pool.clear()
+    _pool.maxsize = maxsize
@@ -3,6 +3,9 @@ import urllib2
 import time
 import lighter.util as util
 
+# Seconds to wait for Datadog to respond
+_TIMEOUT = 10
+
 class Datadog(object):
     def __init__(self, token, tags=[]):
         self._token = token
@@ -43,7 +46,7 @@ class Datadog(object):
         try:
             url = self._url.rstrip('/') + endpoint + '?api_key=' + self._token
             logging.debug('Calling Datadog endpoint %s', endpoint)
-            util.jsonRequest(url, data=data, method='POST')
+            util.jsonRequest(url, data=data, method='POST', timeout=_TIMEOUT)
         except urllib2.URLError as e:
             logging.warn(str(e))
             return {}
@@ -1,13 +1,56 @@
+import os
 import sys
 import re
+import time
+import urllib
 import urllib2
 import logging
 import base64
 import json
+import hashlib
+import threading
+from copy import copy
 import lighter.util as util
+import lighter.cache as cache
+
+# Seconds to wait for a registry to respond
+_TIMEOUT = 15
+
+# Registry endpoints tried in order to resolve the unique version of an image
+_ENDPOINTS = [
+    ('HTTPS v2', '_tryRegistryV2', 'https://%s/v2/%s/manifests/%s'),
+    ('HTTPS v1', '_tryRegistryV1', 'https://%s/v1/repositories/%s/tags/%s'),
+    ('HTTP v2', '_tryRegistryV2', 'http://%s/v2/%s/manifests/%s'),
+    ('HTTP v1', '_tryRegistryV1', 'http://%s/v1/repositories/%s/tags/%s')]
+
+# Manifest formats accepted when resolving image digests
+_DIGEST_ACCEPT = ', '.join([
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.v1+prettyjws'])
+
+# Parsed v1Compatibility section of image manifests, keyed by url and credentials
+_manifests = cache.MemoryCache('docker manifests')
+
+# Index of the endpoint that last worked for each registry, kept in between runs with --cache-dir
+_protocols = {}
+_protocolsLock = threading.Lock()
+_protocolsDisk = None
+
+# Bearer token realm and service of each registry using the token flow, and the tokens keyed
+# by registry, scope and credentials which are shared by all images until they expire
+_challenges = {}
+_tokens = {}
+_tokensLock = threading.Lock()
+_tokenLocks = {}
+
+# Probe all registry endpoints at once instead of one after another, enabled with --parallel-probes
+_parallelProbes = False
 
 class ImageVariables(object):
-    def __init__(self, wrappedResolver, document, image):
+    def __init__(self, wrappedResolver, document, image, uniqueVersion=None):
         m = re.search('^(?:([\w\-]+[\.:].[\w\.\-:]+)/)?(?:([\w\.\-]+)/)?([\w\.\-/]+)(?::([\w\.\-/]+))?$', image)
         if not m:
             raise ValueError("Failed to parse Docker image coordinates '%s'" % image)
@@ -21,16 +64,24 @@ class ImageVariables(object):
         self._repository = m.group(3)
         self._tag = m.group(4) if m.group(4) else 'latest'
         self._auth = util.rget(document, 'docker', 'registries', self._registry, 'auth')
+        self._uniqueVersion = uniqueVersion
+        self._digest = bool(util.rget(document, 'docker', 'digest'))
 
         logging.debug("Parsed image '%s' as %s" % (self._image, (self._registry, self._organization, self._repository, self._tag)))
 
     def clone(self):
-        return ImageVariables(self._wrappedResolver.clone(), self._document, self._image)
+        result = copy(self)
+        result._wrappedResolver = self._wrappedResolver.clone()
+        return result
+
+    @property
+    def registry(self):
+        return self._registry
 
     @staticmethod
-    def create(wrappedResolver, document, image):
+    def create(wrappedResolver, document, image, uniqueVersion=None):
         if image:
-            return ImageVariables(wrappedResolver, document, image)
+            return ImageVariables(wrappedResolver, document, image, uniqueVersion)
         return wrappedResolver
 
     def pop(self, name):
@@ -38,12 +89,13 @@ class ImageVariables(object):
             return self._tag
 
         if name == 'lighter.uniqueVersion':
-            return \
-                self._tryRegistryV2('https://%s/v2/%s/manifests/%s') or \
-                self._tryRegistryV1('https://%s/v1/repositories/%s/tags/%s') or \
-                self._tryRegistryV2('http://%s/v2/%s/manifests/%s') or \
-                self._tryRegistryV1('http://%s/v1/repositories/%s/tags/%s') or \
-                self._fail('https://%s/v2/%s/manifests/%s')
+            # Already resolved when rendering several services
+            if isinstance(self._uniqueVersion, Exception):
+                raise self._uniqueVersion
+            if self._uniqueVersion:
+                return self._uniqueVersion
+
+            return self._uniqueVersionFromRegistry()
 
         if name == 'labels':
             return \
@@ -51,13 +103,45 @@ class ImageVariables(object):
 
         return self._wrappedResolver.pop(name)
 
+    def _uniqueVersionFromRegistry(self):
+        """
+        Tries the endpoint that worked for this registry before, then probes all of them
+        """
+        known = getProtocol(self._registry)
+        if known is not None:
+            result = self._tryEndpoint(known)
+            if result:
+                return result
+            logging.debug('Registry %s no longer answered using %s, probing all endpoints', self._registry, _ENDPOINTS[known][0])
+
+        indexes = [index for index in range(len(_ENDPOINTS)) if index != known]
+
+        # Plain HTTP is only tried once HTTPS has failed, to not send credentials in the clear needlessly
+        for secure in (True, False):
+            stage = [index for index in indexes if _ENDPOINTS[index][2].startswith('https:') == secure]
+
+            # Wait for the answers in priority order, ignoring the probes after the first answer
+            probes = dict((index, Probe(self._tryEndpoint, index)) for index in stage) if _parallelProbes else {}
+
+            for index in stage:
+                result = probes[index].result() if probes else self._tryEndpoint(index)
+                if result:
+                    setProtocol(self._registry, index)
+                    return result
+
+        return self._fail(_ENDPOINTS[0][2])
+
+    def _tryEndpoint(self, index):
+        label, method, url = _ENDPOINTS[index]
+        return getattr(self, method)(url)
+
     def _tryRegistryV1(self, url):
         """
         Resolves an image id using the Docker Registry V1 API
         """
         try:
             expandedurl = self._expandurl(url, defaultrepo=True)
-            response = util.jsonRequest(expandedurl, timeout=15)
+            response = util.jsonRequest(expandedurl, timeout=_TIMEOUT, retry=False)
         except urllib2.HTTPError as e:
             if e.code != 404:
                 obfuscatedurl = self._expandurl(url, defaultrepo=True, obfuscateauth=True)
@@ -76,11 +160,15 @@ class ImageVariables(object):
         """
         Resolves an image id using the Docker Registry V2 API
         """
+        # Prefer the manifest digest which is known without downloading the manifest
+        if self._digest:
+            digest = self._tryRegistryV2Digest(url)
+            if digest:
+                return digest
 
-        # Extract the first compatibility image id if present
-        layerblob = self._tryRegistryV2Response(url)
-        if layerblob:
-            return json.loads(layerblob).get('id')
+        compatibility = self._tryRegistryV2Compatibility(url)
+        if compatibility:
+            return compatibility.get('id')
 
         return None
 
@@ -88,46 +176,216 @@ class ImageVariables(object):
         """
         Resolves an image labels using the Docker Registry V2 API
         """
-
-        # Extract the first compatibility image labels if present
-        layerblob = self._tryRegistryV2Response(url)
-        if layerblob:
-            return json.loads(layerblob).get('config').get('Labels')
+        compatibility = self._tryRegistryV2Compatibility(url)
+        if compatibility:
+            return compatibility.get('config').get('Labels')
 
         return None
 
+    def _tryRegistryV2Digest(self, url):
+        """
+        Resolves the content digest of an image manifest using a HEAD request
+        """
+        key = (self._expandurl(url, withauth=False), self._auth, 'HEAD')
+        try:
+            return _manifests.get(key, lambda: self._tryRegistryV2DigestResponse(url))
+        except urllib2.URLError:
+            # Not cached so an unreachable registry is asked again by the next lookup
+            return None
+
+    def _tryRegistryV2DigestResponse(self, url):
+        try:
+            headers = self._registryRequest(util.headRequest, url, headers={'Accept': _DIGEST_ACCEPT})
+        except urllib2.HTTPError as e:
+            if e.code != 404:
+                obfuscatedurl = self._expandurl(url, obfuscateauth=True)
+                raise RuntimeError("Failed to call %s (%s)" % (obfuscatedurl, e)), None, sys.exc_info()[2]
+            return None
+
+        return headers.getheader('Docker-Content-Digest')
+
+    def _tryRegistryV2Compatibility(self, url):
+        """
+        Returns the parsed first compatibility history object of an image, the manifest is
+        fetched at most once per run and shared by all lookups of the same image. Only
+        manifests and missing manifests are cached, connection failures and timeouts aren't.
+        """
+        key = (self._expandurl(url, withauth=False), self._auth)
+        try:
+            return _manifests.get(key, lambda: self._tryRegistryV2Response(url))
+        except urllib2.URLError:
+            return None
+
     def _tryRegistryV2Response(self, url):
         """
         Return an image first compatibility history object using the Docker Registry V2 API
         """
         try:
-            expandedurl = self._expandurl(url)
-            response = util.jsonRequest(expandedurl, timeout=15)
+            response = self._registryRequest(util.jsonRequest, url)
         except urllib2.HTTPError as e:
             if e.code != 404:
                 obfuscatedurl = self._expandurl(url, obfuscateauth=True)
                 raise RuntimeError("Failed to call %s (%s)" % (obfuscatedurl, e)), None, sys.exc_info()[2]
             return None
-        except urllib2.URLError as e:
-            return None
 
         # Extract the first compatibility image id if present
-        return util.rget(response, 'history', 0, 'v1Compatibility')
+        layerblob = util.rget(response, 'history', 0, 'v1Compatibility')
+        return json.loads(layerblob) if layerblob else None
+
+    def _registryRequest(self, method, url, headers={}):
+        """
+        Calls the Docker Registry V2 API using basic auth, or using a bearer token when
+        the registry asks for one. Failures aren't retried since the next endpoint is probed
+        instead, and an unreachable endpoint would otherwise wait out the timeout repeatedly.
+        """
+        scope = 'repository:%s:pull' % self._repositoryName()
+        for attempt in range(2):
+            token = getToken(self._registry, scope, self._auth)
+            try:
+                if token:
+                    bearer = util.merge(headers, {'Authorization': 'Bearer ' + token})
+                    return method(self._expandurl(url, withauth=False), headers=bearer, timeout=_TIMEOUT, retry=False)
+                return method(self._expandurl(url), headers=headers, timeout=_TIMEOUT, retry=False)
+            except urllib2.HTTPError as e:
+                challenge = parseChallenge(e.info())
+                if e.code != 401 or not challenge or attempt:
+                    raise
+
+                # Get a new token and try again
+                logging.debug('Registry %s requires a bearer token', self._registry)
+                setChallenge(self._registry, scope, self._auth, challenge)
 
     def _fail(self, url):
         raise ValueError("Failed to resolve image version '%s' using URL like %s" % (self._image, self._expandurl(url, obfuscateauth=True)))
 
-    def _expandurl(self, url, defaultrepo=False, obfuscateauth=False):
+    def _expandurl(self, url, defaultrepo=False, obfuscateauth=False, withauth=True):
         registry = self._registry
-        if self._auth:
+        if self._auth and withauth:
             credentials = base64.b64decode(self._auth)
             if obfuscateauth:
                 username, password = credentials.split(':')
                 credentials = username + ':<hidden>'
             registry = '%s@%s' % (credentials, registry)
 
-        repository = self._repository
+        return url % (registry, self._repositoryName(defaultrepo), self._tag)
+
+    def _repositoryName(self, defaultrepo=False):
         if self._organization or defaultrepo:
-            repository = '%s/%s' % (self._organization or 'library', repository)
+            return '%s/%s' % (self._organization or 'library', self._repository)
+        return self._repository
+
+class Probe(object):
+    """
+    Calls a function in a background thread, a result that is never asked for is ignored
+    """
+    def __init__(self, function, *args):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+        thread = threading.Thread(target=self._run, args=(function, args))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, function, args):
+        try:
+            self._result = function(*args)
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._error:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+def parseChallenge(headers):
+    """
+    Parses a 'WWW-Authenticate: Bearer realm="...",service="..."' response header
+    """
+    header = headers.getheader('WWW-Authenticate') if hasattr(headers, 'getheader') else None
+    if not header or not header.strip().lower().startswith('bearer '):
+        return None
+
+    challenge = dict(re.findall(r'(\w+)="([^"]*)"', header))
+    return challenge if challenge.get('realm') else None
+
+def setChallenge(registry, scope, auth, challenge):
+    with _tokensLock:
+        _challenges[registry] = challenge
+        _tokens.pop((registry, scope, auth), None)
+
+def getToken(registry, scope, auth):
+    """
+    Returns a bearer token for a registry that asked for one, a token is requested at most
+    once per registry, scope and credentials until it expires
+    """
+    key = (registry, scope, auth)
+    with _tokensLock:
+        challenge = _challenges.get(registry)
+        if challenge is None:
+            return None
+        lock = _tokenLocks.setdefault(key, threading.Lock())
+
+    with lock:
+        token, expires = _tokens.get(key, (None, 0))
+        if token and time.time() < expires:
+            return token
+
+        token, expires = requestToken(challenge, scope, auth)
+        with _tokensLock:
+            _tokens[key] = (token, expires)
+        return token
+
+def requestToken(challenge, scope, auth):
+    params = {'scope': scope}
+    if challenge.get('service'):
+        params['service'] = challenge['service']
+
+    url = '%s%s%s' % (challenge['realm'], '&' if '?' in challenge['realm'] else '?', urllib.urlencode(sorted(params.items())))
+    try:
+        response = util.jsonRequest(url, headers={'Authorization': 'Basic ' + auth} if auth else {}, timeout=_TIMEOUT)
+    except urllib2.URLError as e:
+        raise RuntimeError("Failed to get a token from %s (%s)" % (url, e)), None, sys.exc_info()[2]
+
+    token = response.get('token') or response.get('access_token')
+    if not token:
+        raise RuntimeError("Failed to get a token from %s" % url)
+
+    # Renew tokens a bit before they expire, the default lifetime is 60 seconds
+    lifetime = int(response.get('expires_in') or 60)
+    return token, time.time() + lifetime * 0.9
+
+def getProtocol(registry):
+    with _protocolsLock:
+        if registry not in _protocols and _protocolsDisk is not None:
+            try:
+                _protocols[registry] = json.loads(_protocolsDisk.get(_protocolKey(registry)) or 'null')
+            except ValueError:
+                _protocols[registry] = None
+        return _protocols.get(registry)
+
+def setProtocol(registry, index):
+    with _protocolsLock:
+        if _protocols.get(registry) == index:
+            return
+        _protocols[registry] = index
+
+    logging.debug('Registry %s answered using %s', registry, _ENDPOINTS[index][0])
+    if _protocolsDisk is not None:
+        _protocolsDisk.put(_protocolKey(registry), json.dumps(index))
+
+def _protocolKey(registry):
+    return hashlib.sha1(registry).hexdigest()
+
+def enableCache(path, maxsize):
+    global _protocolsDisk
+    _protocolsDisk = cache.DiskCache('docker registries', os.path.join(path, 'docker'), maxsize) if path else None
+    with _protocolsLock:
+        _protocols.clear()
 
-        return url % (registry, repository, self._tag)
+def enableParallelProbes(enabled):
+    global _parallelProbes
+    _parallelProbes = enabled
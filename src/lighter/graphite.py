@@ -5,6 +5,9 @@ import time
 import re
 import lighter.util as util
 
+# Seconds to wait for Graphite to respond
+_TIMEOUT = 10
+
 class Graphite(object):
     def __init__(self, address, url, tags=[]):
         """
@@ -48,11 +51,12 @@ class Graphite(object):
             logging.debug('Sending Graphite metric to %s:%s' % (ip, port))
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
+                sock.settimeout(util.requestTimeout(_TIMEOUT))
                 sock.connect((ip, int(port)))
                 sock.send(data)
             finally:
                 sock.close()
-        except (socket.error, ValueError) as e:
+        except (socket.error, urllib2.URLError, ValueError) as e:
             logging.warn('Graphite._send: ' + str(e))
 
     def _call(self, endpoint, data):
@@ -63,7 +67,7 @@ class Graphite(object):
         try:
             url = self._url.rstrip('/') + endpoint
             logging.debug('Calling Graphite endpoint %s', endpoint)
-            util.jsonRequest(url, data=data, method='POST')
+            util.jsonRequest(url, data=data, method='POST', timeout=_TIMEOUT)
         except urllib2.URLError as e:
             logging.warn('Graphite._call: ' + str(e))
             return {}
@@ -2,6 +2,9 @@ import logging
 import urllib2
 import lighter.util as util
 
+# Seconds to wait for HipChat to respond
+_TIMEOUT = 10
+
 class HipChat(object):
     def __init__(self, token, url=None, rooms=[]):
         self._token = token
@@ -27,7 +30,7 @@ class HipChat(object):
         try:
             url = self._url.rstrip('/') + endpoint + '?auth_token=' + self._token
             logging.debug('Calling HipChat endpoint %s', endpoint)
-            util.jsonRequest(url, data=data, method='POST')
+            util.jsonRequest(url, data=data, method='POST', timeout=_TIMEOUT)
         except urllib2.URLError as e:
             logging.warn(str(e))
             return {}
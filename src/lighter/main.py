@@ -1,27 +1,61 @@
 #!/usr/bin/env python
 import os
+import re
 import sys
 import argparse
 import logging
 import hashlib
+import pickle
 import yaml
 import urllib
 import urllib2
 import json
 import time
+import multiprocessing
+import multiprocessing.pool
+import functools
+import threading
+import subprocess
 from copy import copy
 from urlparse import urlparse
-from joblib import Parallel, delayed
 from lighter.hipchat import HipChat
 from lighter.slack import Slack
 import lighter.util as util
 import lighter.maven as maven
 import lighter.docker as docker
 import lighter.secretary as secretary
+import lighter.cache as cache
+import lighter.connections as connections
 from lighter.newrelic import NewRelic
 from lighter.datadog import Datadog
 from lighter.graphite import Graphite
 
+# Parsed globals.yml and profile documents keyed by path and by content
+_files = cache.MemoryCache('files')
+_documents = cache.MemoryCache('documents')
+
+# The globals.yml files that apply to a directory
+_chains = cache.MemoryCache('chains')
+
+# Rendered services from previous runs, enabled with --cache-dir
+_renders = None
+_RENDER_FORMAT = '4'
+
+# Sections that hold credentials aren't cached but merged again when a cached render is used
+_UNCACHED_SECTIONS = ('hipchat', 'slack', 'datadog', 'newrelic', 'graphite', 'docker', 'maven')
+
+# Marks where the value of an environment variable was taken out of a cached render
+_ENV_MARKER_RE = re.compile(u'\0(\\d+)\0')
+
+# Rendering backends, processes avoid contention on the GIL while threads share the caches
+_backends = {'thread': multiprocessing.pool.ThreadPool, 'process': multiprocessing.Pool}
+
+# Seconds to wait for Marathon to respond
+_MARATHON_TIMEOUT = 30
+
+# Concurrent requests to each Maven repository or Docker registry while resolving services
+_HOST_JOBS = 4
+
 def parsebool(value):
     truevals = set(['true', '1'])
     falsevals = set(['false', '0'])
@@ -153,73 +187,154 @@ def apply_canary(canaryGroup, service):
 def cleanup_canaries(marathonurl, canaryGroup, keepServices, noop=False):
     mangledGroup = util.mangle(canaryGroup)
 
-    # Fetch list of current canaries
-    apps = get_marathon_apps(marathonurl, 'com.meltwater.lighter.canary.group==' + mangledGroup)
-
-    # Destroy canaries that are no longer present
+    # Find the current canaries that are no longer present
     keep = set([service.config['id'] for service in keepServices])
-    for app in apps:
+    stale = []
+    for app in get_marathon_apps(marathonurl, 'com.meltwater.lighter.canary.group==' + mangledGroup, fields=['id', 'labels']):
         if app['labels']['com.meltwater.lighter.canary.group'] != mangledGroup:
             raise RuntimeError("Got canary %s not matching group %s" % (app['id'], mangledGroup))
 
         if app['id'] not in keep:
-            if not noop:
-                get_marathon_app(get_marathon_appurl(marathonurl, app['id']), method='DELETE')
-            logging.info("Destroyed old canary %s", app['id'])
+            stale.append(app['id'])
+
+    # Destroy them once the listing has been read
+    for id in stale:
+        if not noop:
+            get_marathon_app(get_marathon_appurl(marathonurl, id), method='DELETE')
+        logging.info("Destroyed old canary %s", id)
 
 def parse_service(filename, canaryGroup=None, profiles=[]):
     logging.info("Processing %s", filename)
-    # Start from a service section if it exists
+    return finish_service(prepare_service(filename, profiles), canaryGroup)
+
+def prepare_service(filename, profiles=[]):
+    """
+    Loads and merges the documents of a service. Returns a dict holding either the rendered
+    document and config when the render cache has them, or the merged but not yet resolved
+    document and config.
+    """
     with open(filename, 'r') as fd:
-        try:
-            document = yaml.load(fd)
-        except yaml.YAMLError as e:
-            raise RuntimeError("Error parsing file %s: %s" % (filename, e))
+        content = fd.read()
+
+    key = fingerprint_service(filename, content, profiles) if _renders is not None else None
+    if key:
+        entry = load_render(filename, key, content, profiles)
+        if entry:
+            return {'filename': filename, 'document': entry['document'], 'config': entry['config'], 'checksum': entry['checksum'], 'rendered': True}
+
+    prepared = merge_service(filename, content, profiles)
+    prepared['key'] = key
+    return prepared
+
+def finish_service(prepared, canaryGroup=None):
+    """
+    Resolves and substitutes a prepared service, then adds the deployment specific parts
+    """
+    filename = prepared['filename']
+    document, config = prepared['document'], prepared['config']
+    if prepared.get('rendered'):
+        # The checksum depends on the key order which isn't kept by the cache
+        checksum = prepared['checksum']
+        config = secretary.apply(document, config)
+    else:
+        document, config, dependencies = expand_service(prepared)
 
-    # Merge globals.yml files into document
-    path = os.path.dirname(os.path.abspath(filename))
-    while '/' in path:
-        candidate = os.path.join(path, 'globals.yml')
-        if os.path.exists(candidate):
-            document = merge_with_service(candidate, document)
-        path = path[0:path.rindex('/')]
+        # Generate deploy keys and encrypt secrets
+        rendered, config = config, secretary.apply(document, config)
+        checksum = util.checksum(config)
 
-    # Merge profile .yml files into document
-    document = merge_with_profiles(document, profiles)
+        if prepared['key'] and dependencies is not None:
+            store_render(filename, prepared['key'], document, rendered, dependencies, checksum)
 
-    variables = util.FixedVariables(document.get('variables', {}))
+    # Include hash of config to detect if an element has been removed
+    config['labels'] = config.get('labels', {})
+    config['labels']['com.meltwater.lighter.checksum'] = checksum
 
-    # Environment variables has higher precedence
-    variables = util.EnvironmentVariables(variables)
+    # Add docker labels to aggregate container metrics on
+    if util.rget(config, 'container', 'docker'):
+        config['container']['docker']['parameters'] = config['container']['docker'].get('parameters', [])
+        config['container']['docker']['parameters'].append({'key': 'label', 'value': 'com.meltwater.lighter.appid='+config['id']})
 
-    # Replace variables in entire document
-    document = util.replace(document, variables, raiseError=False, escapeVar=False)
+    service = Service(filename, document, config)
 
-    config = document.get('service', {})
+    # Apply canarying to avoid collisions on id and servicePort
+    apply_canary(canaryGroup, service)
 
-    # Allow resolving version/uniqueVersion variables from docker registry
-    variables = docker.ImageVariables.create(
-        variables, document, util.rget(config, 'container', 'docker', 'image'))
+    return service
 
-    # Fetch and merge json template from maven
-    if util.rget(document, 'maven', 'version') or util.rget(document, 'maven', 'resolve'):
-        coord = document['maven']
-        versionspec = coord.get('version')
-        if not versionspec:
-            versionspec = coord['resolve']
-            logging.warn("The 'resolve:' tag is deprecated, please switch to 'version:' which is a drop-in replacement in %s" % filename)
+def merge_document(filename, content, profiles):
+    """
+    Merges the globals.yml files and profiles into a service document
+    """
+    # Start from a service section if it exists
+    document = parse_document(filename, content)
+
+    # Merge globals.yml files into document, nearest first
+    for candidate in find_globals(os.path.dirname(os.path.abspath(filename))):
+        document = merge_with_service(candidate, document)
+
+    # Merge profile .yml files into document
+    return merge_with_profiles(document, profiles)
+
+def merge_service(filename, content, profiles):
+    """
+    Merges the globals.yml files and profiles into a service and expands its variables
+    """
+    document = merge_document(filename, content, profiles)
 
-        resolver = maven.ArtifactResolver(coord['repository'], coord['groupid'], coord['artifactid'], coord.get('classifier'))
-        version = resolver.resolve(versionspec)
+    # Replace variables in entire document
+    environment = service_variables(document.get('variables', {}))
+    expanded = util.replace(document, environment, raiseError=False, escapeVar=False)
+
+    prepared = {
+        'filename': filename,
+        'document': expanded,
+        'config': expanded.get('service', {}),
+        'variables': document.get('variables', {}),
+        'env': environment.values}
+
+    prepared['maven'] = maven_coordinates(filename, expanded)
+    prepared['image'] = image_coordinates(prepared)
+    return prepared
+
+def service_variables(variables, env=None):
+    """
+    Returns the variables of a service where environment variables have higher precedence,
+    tracking the environment variables that were used
+    """
+    return util.TrackingVariables(util.EnvironmentVariables(util.FixedVariables(variables)), lambda name: name.startswith('env.'), env)
+
+def expand_service(prepared):
+    """
+    Resolves and substitutes a prepared service, also returns the external inputs that the result
+    depends on or None if the result can't be reused. Artifacts and image versions already resolved
+    by resolve_services() are used instead of asking the repositories again.
+    """
+    filename = prepared['filename']
+    document = prepared['document']
+    config = prepared['config']
+    variables = service_variables(prepared['variables'], dict(prepared['env']))
+    dependencies = {'env': variables.values}
 
-        artifact = resolver.fetch(version)
+    # Allow resolving version/uniqueVersion variables from docker registry
+    image = util.rget(config, 'container', 'docker', 'image')
+    variables = docker.ImageVariables.create(variables, document, image, prepared.get('uniqueVersion'))
+
+    # Fetch and merge json template from maven
+    if prepared['maven']:
+        repository, groupid, artifactid, classifier, versionspec = prepared['maven']
+        artifact = prepared.get('artifact') or resolve_artifact(prepared['maven'])
+        if isinstance(artifact, Exception):
+            raise artifact
         config = util.merge(config, artifact.body)
         variables = maven.ArtifactVariables(variables, artifact)
+        dependencies['maven'] = [repository, groupid, artifactid, classifier, versionspec, artifact.identity]
 
     # Merge overrides into json template
     config = util.merge(config, document.get('override', {}))
 
     # Substitute variables into the config
+    unique = variables = util.TrackingVariables(variables, lambda name: name == 'lighter.uniqueVersion')
     try:
         config = util.replace(config, variables)
     except KeyError as e:
@@ -228,63 +343,465 @@ def parse_service(filename, canaryGroup=None, profiles=[]):
     if 'env' in config:
         config['env'] = process_env(filename, config['env'])
 
-    # Generate deploy keys and encrypt secrets
-    config = secretary.apply(document, config)
-    checksum = util.checksum(config)
+    # The unique version of an image is only known by asking the registry again
+    if image and 'maven' not in dependencies and unique.values.get('lighter.uniqueVersion'):
+        dependencies['image'] = [image, unique.values['lighter.uniqueVersion']]
 
-    # Include hash of config to detect if an element has been removed
-    config['labels'] = config.get('labels', {})
-    config['labels']['com.meltwater.lighter.checksum'] = checksum
+    # Snapshots without a unique version can't be told apart
+    if 'maven' in dependencies and dependencies['maven'][-1] is None:
+        dependencies = None
 
-    # Add docker labels to aggregate container metrics on
-    if util.rget(config, 'container', 'docker'):
-        config['container']['docker']['parameters'] = config['container']['docker'].get('parameters', [])
-        config['container']['docker']['parameters'].append({'key': 'label', 'value': 'com.meltwater.lighter.appid='+config['id']})
+    return document, config, dependencies
 
-    service = Service(filename, document, config)
+def maven_coordinates(filename, document):
+    """
+    Returns the (repository, groupid, artifactid, classifier, versionspec) of the json template, if any
+    """
+    if not (util.rget(document, 'maven', 'version') or util.rget(document, 'maven', 'resolve')):
+        return None
 
-    # Apply canarying to avoid collisions on id and servicePort
-    apply_canary(canaryGroup, service)
+    coord = document['maven']
+    versionspec = coord.get('version')
+    if not versionspec:
+        versionspec = coord['resolve']
+        logging.warn("The 'resolve:' tag is deprecated, please switch to 'version:' which is a drop-in replacement in %s" % filename)
+
+    return coord['repository'], coord['groupid'], coord['artifactid'], coord.get('classifier'), versionspec
+
+def image_coordinates(prepared):
+    """
+    Returns the image of a service when its unique version is referenced and not given by a
+    Maven artifact, together with the registry settings used to look it up
+    """
+    image = util.rget(prepared['config'], 'container', 'docker', 'image')
+    if not image or prepared['maven'] or not mentions(prepared['document'], '%{lighter.uniqueVersion}'):
+        return None
 
-    return service
+    # Leave invalid images to be reported when the service is expanded
+    try:
+        docker.ImageVariables(None, {}, image)
+    except ValueError:
+        return None
 
-def parse_services(filenames, canaryGroup=None, profiles=[]):
-    # return [parse_service(filename) for filename in filenames]
-    return Parallel(n_jobs=8, backend="threading")(delayed(parse_service)(filename, canaryGroup, profiles) for filename in filenames) if filenames else []
+    return image, json.dumps(prepared['document'].get('docker'), sort_keys=True)
+
+def mentions(value, text):
+    if isinstance(value, dict):
+        return any(mentions(item, text) for item in value.itervalues())
+    if isinstance(value, (list, tuple)):
+        return any(mentions(item, text) for item in value)
+    return isinstance(value, (str, unicode)) and text in value
+
+def resolve_artifact(coordinates):
+    repository, groupid, artifactid, classifier, versionspec = coordinates
+    resolver = maven.ArtifactResolver(repository, groupid, artifactid, classifier)
+    return resolver.fetch(resolver.resolve(versionspec))
+
+def resolve_image(coordinates):
+    image, settings = coordinates
+    document = {'docker': json.loads(settings)}
+    return docker.ImageVariables(util.FixedVariables({}), document, image).pop('lighter.uniqueVersion')
+
+def describe_coordinates(kind, coordinates):
+    # Leaves out the repository url and registry settings which may hold credentials
+    if kind == 'artifact':
+        return 'artifact %s:%s:%s' % (coordinates[1], coordinates[2], coordinates[4])
+    return 'image %s' % coordinates[0]
+
+def service_coordinates(filename, profiles=[]):
+    """
+    Returns the (maven, image, rendered) coordinates a service needs resolved, where rendered
+    holds the render taken from the cache. The merged document itself is dropped to keep
+    memory flat.
+    """
+    try:
+        prepared = prepare_service(filename, profiles)
+    except Exception as e:
+        raise portable_error(e, 'Failed to parse %s' % filename), None, sys.exc_info()[2]
+
+    if prepared.get('rendered'):
+        return None, None, prepared
+    return prepared['maven'], prepared['image'], None
+
+def render_service(task, profiles=[], canaryGroup=None):
+    """
+    Merges a service again and finishes it with the artifact and image version resolved for it,
+    a service that was taken from the render cache is finished right away
+    """
+    filename, artifact, uniqueVersion, rendered = task
+    logging.info("Processing %s", filename)
+    try:
+        prepared = rendered or prepare_service(filename, profiles)
+        if not prepared.get('rendered'):
+            prepared['artifact'] = artifact
+            prepared['uniqueVersion'] = uniqueVersion
+        return finish_service(prepared, canaryGroup)
+    except Exception as e:
+        raise portable_error(e, 'Failed to parse %s' % filename), None, sys.exc_info()[2]
+
+def portable_error(e, message):
+    """
+    Returns an exception that can be sent to and from worker processes. Exceptions like
+    urllib2.HTTPError can't be unpickled and would hang the pool, so they're replaced by a
+    RuntimeError describing them.
+    """
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError('%s (%s)' % (message, e))
+
+def resolve_services(coordinates, jobs=8):
+    """
+    Resolves the unique Maven artifacts and image versions in the (maven, image) coordinates
+    of the services concurrently, with at most _HOST_JOBS requests in flight to each host.
+    Returns the results by kind and coordinates, failures are kept and raised by
+    expand_service() for each service that needs the result.
+    """
+    tasks = {}
+    for artifact, image in coordinates:
+        if artifact:
+            tasks[('artifact', artifact)] = urlparse(artifact[0]).hostname
+        if image:
+            tasks[('uniqueVersion', image)] = docker.ImageVariables(None, {}, image[0]).registry
+
+    if not tasks:
+        return {}
+
+    limits = dict((host, threading.BoundedSemaphore(_HOST_JOBS)) for host in tasks.values())
+    resolvers = {'artifact': resolve_artifact, 'uniqueVersion': resolve_image}
+
+    def resolve(task):
+        kind, coordinates = task
+        with limits[tasks[task]]:
+            try:
+                return task, resolvers[kind](coordinates)
+            except Exception as e:
+                # Reported by each service that uses it, possibly in a worker process
+                return task, portable_error(e, 'Failed to resolve %s' % describe_coordinates(kind, coordinates))
+
+    logging.debug('Resolving %d artifacts and images for %d services', len(tasks), len(coordinates))
+    pool = multiprocessing.pool.ThreadPool(max(1, min(jobs, len(tasks))))
+    try:
+        resolved = dict(pool.imap_unordered(resolve, tasks.keys()))
+        pool.close()
+    finally:
+        pool.terminate()
+
+    return resolved
+
+def fingerprint_service(filename, content, profiles):
+    """
+    Hashes the contents of the service file, the globals.yml files and profiles it includes
+    """
+    digest = hashlib.sha1(_RENDER_FORMAT)
+    parts = [filename, hashlib.sha1(content).hexdigest()]
+    for candidate in find_globals(os.path.dirname(os.path.abspath(filename))) + tuple(profiles):
+        parts.extend([candidate, read_document(candidate)[0]])
+
+    for part in parts:
+        digest.update(part + '\0')
+    return digest.hexdigest()
+
+def load_render(filename, key, content, profiles):
+    try:
+        entry = json.loads(_renders.get(key) or 'null')
+    except ValueError:
+        entry = None
 
-def write_services(targetdir, services):
-    for service in services:
+    if not entry:
+        return None
+
+    # Put the values of the environment variables back in
+    values = [os.environ.get(name[4:]) for name in entry['environment']]
+    if None in values:
+        logging.debug('Cached render of %s is outdated', filename)
+        return None
+
+    try:
+        entry = reveal(entry, [value.decode('utf-8') for value in values])
+    except UnicodeDecodeError:
+        return None
+
+    entry['document'].update(uncached_sections(filename, content, profiles))
+
+    if not is_current_render(entry['document'], entry['dependencies']):
+        logging.debug('Cached render of %s is outdated', filename)
+        return None
+
+    logging.debug('Using cached render of %s', filename)
+    return entry
+
+def uncached_sections(filename, content, profiles):
+    """
+    Merges and expands the sections of a service that are left out of its cached render
+    """
+    document = merge_document(filename, content, profiles)
+    sections = dict((name, document[name]) for name in _UNCACHED_SECTIONS if name in document)
+    return util.replace(sections, service_variables(document.get('variables', {})), raiseError=False, escapeVar=False)
+
+def store_render(filename, key, document, config, dependencies, checksum):
+    # Keep credentials and the values of environment variables off the disk, only hashes of
+    # them are kept and the values are put back in from the environment when the entry is used
+    environment = dict((value, name) for name, value in dependencies['env'].iteritems() if value)
+    document = dict((name, value) for name, value in document.iteritems() if name not in _UNCACHED_SECTIONS)
+    dependencies = dict(dependencies, env=dict((name, hash_value(value)) for name, value in dependencies['env'].iteritems()))
+    if dependencies.get('maven'):
+        dependencies['maven'] = [hash_value(dependencies['maven'][0])] + dependencies['maven'][1:]
+
+    try:
+        entry = {'document': document, 'config': config, 'dependencies': dependencies, 'checksum': checksum, 'environment': []}
+        if environment:
+            # Longer values first so a value that contains another one is taken out as a whole
+            values = sorted(environment, key=len, reverse=True)
+            markers = dict((value.decode('utf-8'), u'\0%d\0' % index) for index, value in enumerate(values))
+            pattern = re.compile(u'|'.join(re.escape(value) for value in markers))
+            entry = conceal(entry, pattern, markers)
+            entry['environment'] = [environment[value] for value in values]
+
+        content = json.dumps(entry)
+    except (TypeError, ValueError) as e:
+        logging.debug('Not caching render of %s (%s)', filename, e)
+        return
+
+    _renders.put(key, content)
+
+def conceal(value, pattern, markers):
+    """
+    Replaces the matches of a pattern in all keys and strings by their markers
+    """
+    if isinstance(value, dict):
+        return dict((conceal(key, pattern, markers), conceal(item, pattern, markers)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [conceal(item, pattern, markers) for item in value]
+    if isinstance(value, (str, unicode)):
+        if u'\0' in value:
+            raise ValueError('Found a NUL character')
+        return pattern.sub(lambda match: markers[match.group(0)], value)
+    return value
+
+def reveal(value, values):
+    """
+    Replaces the markers written by conceal() by the values they stand for
+    """
+    if isinstance(value, dict):
+        return dict((reveal(key, values), reveal(item, values)) for key, item in value.iteritems())
+    if isinstance(value, list):
+        return [reveal(item, values) for item in value]
+    if isinstance(value, unicode):
+        return _ENV_MARKER_RE.sub(lambda match: values[int(match.group(1))], value)
+    return value
+
+def is_current_render(document, dependencies):
+    """
+    Checks that the environment variables, artifacts and images used by a cached render are unchanged
+    """
+    for name, value in dependencies['env'].iteritems():
+        if hash_value(os.environ.get(name[4:])) != value:
+            return False
+
+    if dependencies.get('maven'):
+        # Only a hash of the repository url is cached since it may hold credentials
+        repository, groupid, artifactid, classifier, versionspec, identity = dependencies['maven']
+        url = util.rget(document, 'maven', 'repository')
+        if hash_value(url) != repository:
+            return False
+
+        resolver = maven.ArtifactResolver(url, groupid, artifactid, classifier)
+        if resolver.identify(resolver.resolve(versionspec)) != identity:
+            return False
+
+    if dependencies.get('image'):
+        image, uniqueVersion = dependencies['image']
+        if docker.ImageVariables(util.FixedVariables({}), document, image).pop('lighter.uniqueVersion') != uniqueVersion:
+            return False
+
+    return True
+
+def hash_value(value):
+    if value is None:
+        return None
+    return hashlib.sha1(value.encode('utf-8') if isinstance(value, unicode) else value).hexdigest()
+
+def enable_render_cache(path, maxsize):
+    global _renders
+    _renders = cache.DiskCache('renders', os.path.join(path, 'renders'), maxsize) if path else None
+
+def parse_services(filenames, canaryGroup=None, profiles=[], jobs=8, backend='thread'):
+    return list(iparse_services(filenames, canaryGroup, profiles, jobs, backend))
+
+def iparse_services(filenames, canaryGroup=None, profiles=[], jobs=8, backend='thread'):
+    """
+    Renders services in phases, first all documents are merged to find the artifacts and
+    images they use, then those are resolved once, and finally each document is merged again
+    and substituted. Only the coordinates and the renders taken from the cache are kept
+    between the phases, so memory stays flat at the cost of merging every service twice.
+    Yields the services in the order of the given files as soon as each is ready.
+    """
+    if not filenames:
+        return
+
+    pool = _backends[backend](max(1, min(jobs, len(filenames))))
+    try:
+        coordinates = list(imap_counted(pool, backend, functools.partial(service_coordinates, profiles=profiles), filenames))
+        resolved = resolve_services([(artifact, image) for artifact, image, rendered in coordinates], jobs)
+
+        tasks = ((filename, resolved.get(('artifact', artifact)), resolved.get(('uniqueVersion', image)), rendered)
+                 for filename, (artifact, image, rendered) in zip(filenames, coordinates))
+        for service in imap_counted(pool, backend, functools.partial(render_service, profiles=profiles, canaryGroup=canaryGroup), tasks):
+            yield service
+        pool.close()
+    finally:
+        pool.terminate()
+
+def imap_counted(pool, backend, function, iterable):
+    """
+    Maps function over iterable in the pool, and adds the cache hits and misses counted
+    by worker processes to the caches of this process so they're logged at the end
+    """
+    if backend != 'process':
+        for result in pool.imap(function, iterable):
+            yield result
+        return
+
+    for result, counts in pool.imap(functools.partial(counted_call, function), iterable):
+        cache.addStatistics(counts)
+        yield result
+
+def counted_call(function, item):
+    before = cache.statistics()
+    return function(item), cache.countedSince(before)
+
+def changed_services(filenames, profiles, revision):
+    """
+    Returns the service files whose service file, globals.yml files or profiles have
+    changed since the given git revision
+    """
+    if not filenames:
+        return filenames
+
+    # Map each input file to the services that include it, globals.yml files that are added
+    # or removed in a parent directory also affect a service
+    dependents = {}
+    for filename in filenames:
+        inputs = [filename] + profiles
+        path = os.path.dirname(os.path.realpath(filename))
+        while '/' in path:
+            inputs.append(os.path.join(path, 'globals.yml'))
+            path = path[0:path.rindex('/')]
+
+        for dependency in inputs:
+            dependents.setdefault(os.path.realpath(dependency), set()).add(filename)
+
+    affected = set()
+    for change in git_changes(os.path.dirname(os.path.realpath(filenames[0])), revision):
+        affected.update(dependents.get(change, ()))
+
+    result = [filename for filename in filenames if filename in affected]
+    logging.info("Found %d of %d services changed since %s", len(result), len(filenames), revision)
+    return result
+
+def git_changes(path, revision):
+    """
+    Returns the absolute paths of files that are modified, added, removed or untracked since a git revision,
+    a renamed file is listed with both its old and its new path
+    """
+    try:
+        toplevel = subprocess.check_output(['git', 'rev-parse', '--show-toplevel'], cwd=path).strip()
+        changes = subprocess.check_output(['git', 'diff', '--name-only', '--no-renames', '-z', revision, '--'], cwd=toplevel).split('\0')
+        changes += subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard', '-z'], cwd=toplevel).split('\0')
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError("Failed to list changes since %s in %s (%s)" % (revision, path, e))
+
+    return set(os.path.realpath(os.path.join(toplevel, change)) for change in changes if change)
+
+class ServiceWriter(object):
+    """
+    Writes rendered services to the target directory, creating each directory only once
+    """
+    def __init__(self, targetdir):
+        self._targetdir = targetdir
+        self._directories = set()
+
+    def write(self, service):
         # Write json file to disk for logging purposes
-        outputfile = os.path.join(targetdir, service.filename + '.json')
+        outputfile = os.path.join(self._targetdir, service.filename + '.json')
+        directory = os.path.dirname(outputfile)
 
-        # Exception if directory exists, e.g. because another thread created it concurrently
-        try:
-            os.makedirs(os.path.dirname(outputfile))
-        except OSError:
-            pass
+        if directory not in self._directories:
+            # Exception if directory exists, e.g. because another process created it concurrently
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+            self._directories.add(directory)
 
         with open(outputfile, 'w') as fd:
             fd.write(util.toJson(service.config, indent=4))
 
+def write_services(targetdir, services):
+    writer = ServiceWriter(targetdir)
+    for service in services:
+        writer.write(service)
+
 def merge_with_profiles(document, profiles):
     for profile in profiles:
         document = merge_with_service(profile, document)
     return document
 
 def merge_with_service(override_file, document):
-    if not os.path.exists(override_file):
-        raise RuntimeError('Could not read file %s' % override_file)
+    return util.merge(load_document(override_file), document)
 
-    with open(override_file, 'r') as fd2:
-        document = util.merge(yaml.load(fd2), document)
-    return document
+def find_globals(path):
+    """
+    Returns the globals.yml files that apply to a directory, nearest first
+    """
+    if '/' not in path:
+        return ()
+
+    def find():
+        parent = find_globals(path[0:path.rindex('/')])
+        candidate = os.path.join(path, 'globals.yml')
+        if os.path.exists(candidate):
+            return (candidate,) + parent
+        return parent
+
+    return _chains.get(path, find)
+
+def load_document(filename):
+    """
+    Returns the parsed contents of a shared yaml file, each file is read and parsed only once
+    per run. The result is shared between services and must not be modified by the caller.
+    """
+    return read_document(filename)[1]
+
+def read_document(filename):
+    """
+    Returns the content digest and parsed contents of a shared yaml file
+    """
+    def read():
+        if not os.path.exists(filename):
+            raise RuntimeError('Could not read file %s' % filename)
+
+        with open(filename, 'r') as fd:
+            content = fd.read()
+        digest = hashlib.sha1(content).hexdigest()
+        return digest, _documents.get(digest, lambda: parse_document(filename, content))
+
+    return _files.get(os.path.abspath(filename), read)
+
+def parse_document(filename, content):
+    try:
+        return yaml.load(content)
+    except yaml.YAMLError as e:
+        raise RuntimeError("Error parsing file %s: %s" % (filename, e))
 
 def get_marathon_appurl(url, id, force=False):
     return url.rstrip('/') + '/v2/apps/' + id.strip('/') + (force and '?force=true' or '')
 
 def get_marathon_app(url, method='GET'):
     try:
-        response = util.jsonRequest(url, method=method)
+        response = util.jsonRequest(url, method=method, timeout=_MARATHON_TIMEOUT)
         if method == 'GET':
             return response['app']
         return response
@@ -298,15 +815,19 @@ def get_marathon_app(url, method='GET'):
         logging.debug(str(e))
         raise RuntimeError("Failed to %s app %s (%s)" % (method, url, e)), None, sys.exc_info()[2]
 
-def get_marathon_apps(url, labelFilter):
+def get_marathon_apps(url, labelFilter, fields=None):
+    """
+    Yields the apps matching a label filter one at a time, keeping only the given fields
+    """
     appsurl = url.rstrip('/') + '/v2/apps?' + urllib.urlencode({'label': labelFilter})
 
     try:
-        return util.jsonRequest(appsurl)['apps']
+        for app in util.jsonStream(appsurl, 'apps', fields, timeout=_MARATHON_TIMEOUT):
+            yield app
     except urllib2.HTTPError as e:
         logging.debug(str(e))
         if e.code == 404:
-            return {}
+            return
         else:
             raise RuntimeError("Failed to fetch apps %s HTTP %d (%s) - Response: %s" % (url, e.code, e, e.read())), None, sys.exc_info()[2]
     except urllib2.URLError as e:
@@ -395,44 +916,123 @@ def notify(targetMarathonUrl, service):
             service.id, service.image, service.environment, parsedMarathonUrl.netloc),
         tags=tags)
 
-def deploy(marathonurl, filenames, noop=False, force=False, canaryGroup=None, profiles=[]):
-    services = parse_services(filenames, canaryGroup, profiles)
+class ServiceLogs(logging.Filter):
+    """
+    Holds back the log records of services deployed in worker threads and emits the records
+    of each service together once it's done, so the logs of concurrent deploys don't interleave
+    """
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        records = self._records.get(record.thread)
+        if records is None:
+            return True
+
+        # Each handler filters the same record
+        if not records or records[-1] is not record:
+            records.append(record)
+        return False
 
-    for service in services:
+    def capture(self):
+        self._records[threading.current_thread().ident] = []
+
+    def flush(self):
+        records = self._records.pop(threading.current_thread().ident, [])
+        with self._lock:
+            for record in records:
+                logging.getLogger().handle(record)
+
+    def __enter__(self):
+        for handler in logging.getLogger().handlers:
+            handler.addFilter(self)
+        return self
+
+    def __exit__(self, *args):
+        for handler in logging.getLogger().handlers:
+            handler.removeFilter(self)
+
+def deploy(marathonurl, filenames, noop=False, force=False, canaryGroup=None, profiles=[], jobs=8, backend='thread', targetdir=None, concurrency=1):
+    # Render all services before deploying any of them, writing each to disk as soon as it's ready
+    writer = ServiceWriter(targetdir) if targetdir else None
+    services = []
+    for service in iparse_services(filenames, canaryGroup, profiles, jobs, backend):
+        if writer:
+            writer.write(service)
+        services.append(service)
+
+    if concurrency <= 1 or len(services) <= 1:
+        for service in services:
+            deploy_service(marathonurl, service, noop, force)
+        return services
+
+    # Deploy services concurrently and report all failures once every service has been handled
+    with ServiceLogs() as logs:
+        def worker(service):
+            logs.capture()
+            try:
+                deploy_service(marathonurl, service, noop, force)
+            except Exception as e:
+                return e
+            finally:
+                logs.flush()
+
+        pool = multiprocessing.pool.ThreadPool(min(concurrency, len(services)))
         try:
-            targetMarathonUrl = marathonurl or util.rget(service.document, 'marathon', 'url')
-            if not targetMarathonUrl:
-                raise RuntimeError("No Marathon URL defined for service %s" % service.filename)
-
-            # See if service config has changed by comparing the checksum
-            appurl = get_marathon_appurl(targetMarathonUrl, service.config['id'], force)
-            prevVersion = get_marathon_app(appurl)
-            if util.rget(prevVersion, 'labels', 'com.meltwater.lighter.checksum') == service.checksum:
-                logging.info("Service already deployed with same config: %s", service.filename)
-                continue
+            errors = [e for e in pool.map(worker, services) if e is not None]
+            pool.close()
+        finally:
+            pool.terminate()
 
-            # Skip deployment if noop flag is given
-            if noop:
-                continue
-
-            # Deploy new service config
-            logging.info("Deploying %s", service.filename)
-            util.jsonRequest(appurl, data=service.config, method='PUT')
+    if errors:
+        raise RuntimeError("Failed to deploy %d of %d services:\n%s" % (len(errors), len(services), '\n'.join(str(e) for e in errors)))
+    return services
 
-            # Send deployment notifications
-            notify(targetMarathonUrl, service)
-        except urllib2.HTTPError as e:
-            raise RuntimeError("Failed to deploy %s HTTP %d (%s) - Response: %s" % (service.filename, e.code, e, e.read())), None, sys.exc_info()[2]
-        except urllib2.URLError as e:
-            raise RuntimeError("Failed to deploy %s (%s)" % (service.filename, e)), None, sys.exc_info()[2]
+def deploy_service(marathonurl, service, noop=False, force=False):
+    try:
+        targetMarathonUrl = marathonurl or util.rget(service.document, 'marathon', 'url')
+        if not targetMarathonUrl:
+            raise RuntimeError("No Marathon URL defined for service %s" % service.filename)
+
+        # See if service config has changed by comparing the checksum
+        appurl = get_marathon_appurl(targetMarathonUrl, service.config['id'], force)
+        prevVersion = get_marathon_app(appurl)
+        if util.rget(prevVersion, 'labels', 'com.meltwater.lighter.checksum') == service.checksum:
+            logging.info("Service already deployed with same config: %s", service.filename)
+            return
+
+        # Skip deployment if noop flag is given
+        if noop:
+            return
+
+        # Deploy new service config
+        logging.info("Deploying %s", service.filename)
+        util.jsonRequest(appurl, data=service.config, method='PUT', timeout=_MARATHON_TIMEOUT)
+
+        # Send deployment notifications
+        notify(targetMarathonUrl, service)
+    except urllib2.HTTPError as e:
+        raise RuntimeError("Failed to deploy %s HTTP %d (%s) - Response: %s" % (service.filename, e.code, e, e.read())), None, sys.exc_info()[2]
+    except urllib2.URLError as e:
+        raise RuntimeError("Failed to deploy %s (%s)" % (service.filename, e)), None, sys.exc_info()[2]
 
-    return services
+def verify(filenames, canaryGroup=None, profiles=[], jobs=8, backend='thread', targetdir=None, enforceSecrets=False):
+    # Check and write each service as soon as it's rendered and don't keep it around
+    writer = ServiceWriter(targetdir) if targetdir else None
+    for service in iparse_services(filenames, canaryGroup, profiles, jobs, backend):
+        # Check for unencrypted secrets
+        verify_secrets([service], enforceSecrets)
 
-def verify(filenames, canaryGroup=None, profiles=[]):
-    return parse_services(filenames, canaryGroup, profiles)
+        if writer:
+            writer.write(service)
 
 
 if __name__ == '__main__':
+    # Allow the process backend to start workers from the frozen binary
+    multiprocessing.freeze_support()
+
     parser = argparse.ArgumentParser(
         prog='lighter',
         usage='%(prog)s COMMAND [OPTIONS]...',
@@ -446,6 +1046,30 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--targetdir', dest='targetdir', help='Directory to output rendered config files',
                         default=None)
     parser.add_argument('-p', '--profile', dest='profiles', default=[], action='append', help='Extra profile files to be merged with service definitions.')
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of services to render in parallel [default: %(default)s]',
+                        type=int, default=8)
+    parser.add_argument('--cache-dir', dest='cacheDir',
+                        help='Directory to keep rendered services, Maven downloads and Docker registry endpoints in between runs [default: %(default)s]',
+                        default=None)
+    parser.add_argument('--cache-size', dest='cacheSize', help='Maximum size in megabytes of each cache in the cache directory [default: %(default)s]',
+                        type=int, default=256)
+    parser.add_argument('--cache-ttl', dest='cacheTtl', help='Seconds until cached Maven metadata and snapshots are downloaded again [default: %(default)s]',
+                        type=int, default=300)
+    parser.add_argument('--changed-since', dest='changedSince', help='Only process services affected by changes since this git revision [default: %(default)s]',
+                        default=None)
+    parser.add_argument('--backend', dest='backend', help='Render services in threads or worker processes [default: %(default)s]',
+                        choices=sorted(_backends.keys()), default='thread')
+    parser.add_argument('--idle-connections', dest='idleConnections',
+                        help='Number of idle connections kept open to each host for reuse. This doesn\'t limit how many requests run at once '
+                             'per host, a new connection is opened when none is idle. 0 disables keep-alive [default: %(default)s]',
+                        type=int, default=8)
+    parser.add_argument('--retries', dest='retries', help='Number of times to retry failed requests to Marathon, Maven and Docker [default: %(default)s]',
+                        type=int, default=3)
+    parser.add_argument('--deadline', dest='deadline',
+                        help='Time limit for the whole run like 90s, 10m or 1h, requests fail once it has passed [default: %(default)s]',
+                        type=util.parseDuration, default=None)
+    parser.add_argument('--parallel-probes', dest='parallelProbes', help='Probe all Docker registry endpoints at once [default: %(default)s]',
+                        action='store_true', default=False)
 
     # Create the parser for the "deploy" command
     deploy_parser = subparsers.add_parser('deploy',
@@ -465,6 +1089,10 @@ if __name__ == '__main__':
                                help='Force deployment even if the service is already affected by a running deployment [default: %(default)s]',
                                action='store_true', default=False)
 
+    deploy_parser.add_argument('--deploy-concurrency', dest='deployConcurrency',
+                               help='Number of services to deploy to Marathon in parallel [default: %(default)s]',
+                               type=int, default=1)
+
     deploy_parser.add_argument('--canary-group', dest='canaryGroup', help='Unique name for this group of canaries [default: %(default)s]',
                                default=None)
     deploy_parser.add_argument('--canary-cleanup', dest='canaryCleanup', help='Destroy canaries that are no longer present [default: %(default)s]',
@@ -493,10 +1121,23 @@ if __name__ == '__main__':
     else:
         logging.getLogger().setLevel(logging.INFO)
 
+    enable_render_cache(args.cacheDir, args.cacheSize * 1024 * 1024)
+    maven.enableCache(args.cacheDir, args.cacheSize * 1024 * 1024, args.cacheTtl)
+    docker.enableCache(args.cacheDir, args.cacheSize * 1024 * 1024)
+    docker.enableParallelProbes(args.parallelProbes)
+    connections.enablePool(args.idleConnections)
+    util.enableRetries(args.retries)
+    util.enableDeadline(args.deadline)
+
     try:
-        services = []
+        if args.changedSince:
+            if args.command == 'deploy' and args.canaryCleanup:
+                raise RuntimeError("Canary cleanup requires all services and can't be combined with --changed-since")
+            args.filenames = changed_services(args.filenames, args.profiles, args.changedSince)
+
         if args.command == 'deploy':
-            services = deploy(args.marathon, noop=args.noop, force=args.force, filenames=args.filenames, canaryGroup=args.canaryGroup, profiles=args.profiles)
+            services = deploy(args.marathon, noop=args.noop, force=args.force, filenames=args.filenames, canaryGroup=args.canaryGroup, profiles=args.profiles,
+                              jobs=args.jobs, backend=args.backend, targetdir=args.targetdir, concurrency=args.deployConcurrency)
 
             # Destroy canaries that are no longer rendered
             if args.canaryGroup and args.canaryCleanup:
@@ -504,14 +1145,9 @@ if __name__ == '__main__':
                     raise RuntimeError("Canary cleanup requires Marathon URL to be given on the command line")
                 cleanup_canaries(args.marathon, args.canaryGroup, services, args.noop)
         elif args.command == 'verify':
-            services = verify(args.filenames, profiles=args.profiles)
-
-            # Check for unencrypted secrets
-            verify_secrets(services, args.verifySecrets)
-
-        # Dump rendered files to disk
-        if args.targetdir:
-            write_services(args.targetdir, services)
+            verify(args.filenames, profiles=args.profiles, jobs=args.jobs, backend=args.backend, targetdir=args.targetdir, enforceSecrets=args.verifySecrets)
     except RuntimeError as e:
         logging.error(str(e))
         sys.exit(1)
+    finally:
+        cache.logStatistics()
@@ -1,8 +1,30 @@
+import os
 import sys
 import re
+import json
+import time
+import bisect
+import hashlib
 import urllib2
 import logging
 import lighter.util as util
+import lighter.cache as cache
+
+# Metadata and artifacts shared by all resolvers during a run, keyed by url
+_responses = cache.MemoryCache('maven')
+
+# Sorted versions of each artifact, keyed by the url of its metadata
+_indexes = cache.MemoryCache('maven versions')
+
+# Downloads kept in between runs, enabled with --cache-dir
+_downloads = None
+_ttl = 0
+
+# Seconds to wait for a Maven repository to respond
+_TIMEOUT = 30
+
+# The parts of maven-metadata.xml used to resolve versions and snapshots
+_METADATA_PATHS = ['versioning/versions/version', 'versioning/snapshot', 'versioning/lastUpdated']
 
 class VersionRange(object):
     SPLIT = re.compile('[^\d\w_]+')
@@ -46,26 +68,68 @@ class VersionRange(object):
             return tuple(int(digit) for digit in VersionRange.SPLIT.split(version.split('-')[0]) if digit.isdigit())
         return None
 
+    @staticmethod
+    def sortKey(version):
+        # Snapshots are less than a release with the same version number
+        return VersionRange.parseVersion(version), not VersionRange.issnapshot(version)
+
     @staticmethod
     def compareVersions(a, b):
-        av = VersionRange.parseVersion(a)
-        bv = VersionRange.parseVersion(b)
-        result = cmp(av, bv)
+        return cmp(VersionRange.sortKey(a), VersionRange.sortKey(b))
 
-        # Snapshots are less than a release with the same version number
-        if result == 0:
-            if VersionRange.issnapshot(a) and not VersionRange.issnapshot(b):
-                result = -1
-            elif not VersionRange.issnapshot(a) and VersionRange.issnapshot(b):
-                result = 1
+class VersionIndex(object):
+    """
+    Versions of an artifact parsed once and sorted, grouped by suffix since a range
+    only matches versions with the same suffix as its bounds
+    """
+    def __init__(self, versions):
+        self._keys = {}
+        self._versions = {}
+
+        # The sort is stable so the last of several equal versions is preferred like before
+        for version in sorted(versions, key=VersionRange.sortKey):
+            suffix = VersionRange.suffix(version)
+            self._keys.setdefault(suffix, []).append(VersionRange.parseVersion(version))
+            self._versions.setdefault(suffix, []).append(version)
+
+    def __len__(self):
+        return sum(len(versions) for versions in self._versions.itervalues())
+
+    def select(self, matcher):
+        """
+        Returns the greatest version accepted by the VersionRange, or None
+        """
+        keys = self._keys.get(matcher._suffix, [])
+
+        lower = 0
+        if matcher._lversion is not None:
+            lower = (bisect.bisect_left if matcher._lbound == '[' else bisect.bisect_right)(keys, matcher._lversion)
 
-        return result
+        upper = len(keys)
+        if matcher._rversion is not None:
+            upper = (bisect.bisect_right if matcher._rbound == ']' else bisect.bisect_left)(keys, matcher._rversion)
+
+        return self._versions[matcher._suffix][upper - 1] if upper > lower else None
 
 class Artifact(object):
-    def __init__(self, version, uniqueVersion, classifier, body):
+    def __init__(self, version, uniqueVersion, classifier, content):
         self.version = version
         self.uniqueVersion = (uniqueVersion or version) + (classifier and ('-' + classifier) or '')
-        self.body = body
+        self.content = content
+        self.body = json.loads(content) if content is not None else None
+
+        # Identifies the contents of the artifact, snapshots without a unique version may change at any time
+        self.identity = None if (VersionRange.issnapshot(version) and not uniqueVersion) else self.uniqueVersion
+
+    def __getstate__(self):
+        # Decode the body again in render workers, pickled dicts may not iterate in the same order
+        state = dict(self.__dict__)
+        del state['body']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.body = json.loads(self.content) if self.content is not None else None
 
 class ArtifactVariables(object):
     def __init__(self, wrappedResolver, artifact):
@@ -93,9 +157,20 @@ class ArtifactResolver(object):
         return self.fetch(version).body
 
     def fetch(self, version):
+        snapshot, metadata = self._snapshot(version)
+        return self._fetch(version, snapshot, metadata)
+
+    def identify(self, version):
+        """
+        Returns the identity of an artifact without downloading the artifact itself
+        """
+        snapshot, metadata = self._snapshot(version)
+        return Artifact(version, self._uniqueVersion(version, snapshot, metadata), self._classifier, None).identity
+
+    def _snapshot(self, version):
         trailer = '-SNAPSHOT'
         if not version.endswith(trailer):
-            return self._fetch(version)
+            return None, {}
 
         # Try to resolve unique/timestamped snapshot versions from maven-metadata.xml
         logging.debug('Trying to resolve %s to a unique timestamp-buildnumber version', version)
@@ -103,7 +178,7 @@ class ArtifactResolver(object):
         metadata = {}
 
         try:
-            metadata = util.xmlRequest(url)
+            metadata = request(metadataRequest, url)
         except urllib2.URLError:
             logging.debug('Failed to fetch %s', url)
 
@@ -112,23 +187,27 @@ class ArtifactResolver(object):
         buildNumber = util.rget(metadata, 'versioning', 'snapshot', 'buildNumber')
         snapshot = '-'.join(filter(bool, [version[0:len(version) - len(trailer)], timestamp, buildNumber])
                             ) if (timestamp is not None and buildNumber is not None) else None
-        return self._fetch(version, snapshot, metadata)
-
-    def _fetch(self, version, uniqueVersion=None, metadata={}):
-        url = '{0}/{1}/{2}/{3}/{2}-{4}'.format(self._url, self._groupid.replace('.', '/'), self._artifactid, version, uniqueVersion or version)
-        if self._classifier is not None:
-            url += '-' + self._classifier
-        url += '.json'
+        return snapshot, metadata
 
+    def _uniqueVersion(self, version, uniqueVersion, metadata):
         # Extract unique version number from metadata
         if not uniqueVersion:
             timestamp = util.rget(metadata, 'versioning', 'snapshot', 'timestamp') or util.rget(metadata, 'versioning', 'lastUpdated')
             buildNumber = util.rget(metadata, 'versioning', 'snapshot', 'buildNumber')
             if timestamp or buildNumber:
                 uniqueVersion = '-'.join(filter(bool, [version.replace('-SNAPSHOT', ''), timestamp, buildNumber]))
+        return uniqueVersion
+
+    def _fetch(self, version, uniqueVersion=None, metadata={}):
+        url = '{0}/{1}/{2}/{3}/{2}-{4}'.format(self._url, self._groupid.replace('.', '/'), self._artifactid, version, uniqueVersion or version)
+        if self._classifier is not None:
+            url += '-' + self._classifier
+        url += '.json'
 
         try:
-            return Artifact(version, uniqueVersion, self._classifier, util.jsonRequest(url))
+            # Released and timestamped snapshot artifacts never change
+            immutable = bool(uniqueVersion) or not VersionRange.issnapshot(version)
+            return Artifact(version, self._uniqueVersion(version, uniqueVersion, metadata), self._classifier, request(artifactRequest, url, immutable))
         except urllib2.HTTPError as e:
             raise RuntimeError("Failed to retrieve %s HTTP %d (%s)" % (url, e.code, e)), None, sys.exc_info()[2]
         except urllib2.URLError as e:
@@ -140,19 +219,91 @@ class ArtifactResolver(object):
             return expression
 
         # Fetch the available versions for this artifact
-        metadata = util.xmlRequest('{0}/{1}/{2}/maven-metadata.xml'.format(self._url, self._groupid.replace('.', '/'), self._artifactid))
-        versions = util.toList(util.rget(metadata, 'versioning', 'versions', 'version'))
-        logging.debug('%s:%s candidate versions %s', self._groupid, self._artifactid, versions)
+        url = '{0}/{1}/{2}/maven-metadata.xml'.format(self._url, self._groupid.replace('.', '/'), self._artifactid)
+        index = _indexes.get(url, lambda: self._index(url))
 
         # Select the version that best matches the version range expression
-        return self.selectVersion(expression, versions)
+        return self.selectVersion(expression, index)
+
+    def _index(self, url):
+        metadata = request(metadataRequest, url)
+        versions = util.toList(util.rget(metadata, 'versioning', 'versions', 'version'))
+        logging.debug('%s:%s candidate versions %s', self._groupid, self._artifactid, versions)
+        return VersionIndex(versions)
 
     def selectVersion(self, expression, versions):
-        matcher = VersionRange(expression)
-        matches = [version for version in versions if matcher.accepts(version)]
-        matches.sort(VersionRange.compareVersions)
-        logging.debug('%s:%s matched %s to versions %s', self._groupid, self._artifactid, expression, matches)
+        index = versions if isinstance(versions, VersionIndex) else VersionIndex(versions)
+        match = index.select(VersionRange(expression))
+        logging.debug('%s:%s matched %s to version %s', self._groupid, self._artifactid, expression, match)
 
-        if not matches:
+        if match is None:
             raise RuntimeError('Failed to find a version that matches %s' % expression)
-        return matches[-1]
+        return match
+
+def metadataRequest(url, **kwargs):
+    """
+    Fetches a maven-metadata.xml file, skipping the parts that aren't used
+    """
+    return util.xmlRequest(url, paths=_METADATA_PATHS, timeout=_TIMEOUT, **kwargs)
+
+def artifactRequest(url, **kwargs):
+    """
+    Fetches the json text of an artifact. The text is what's cached and decoded for each use,
+    since the config checksums depend on the key order that decoding it gives.
+    """
+    return util.jsonText(url, timeout=_TIMEOUT, **kwargs)
+
+def request(method, url, immutable=False):
+    """
+    Fetches a url at most once per run, concurrent requests for the same url wait for the
+    first one to complete. The response is shared and must not be modified by the caller.
+    """
+    def fetch():
+        try:
+            return download(method, url, immutable), None
+        except urllib2.HTTPError as e:
+            # Remember missing files but retry other errors
+            if e.code != 404:
+                raise
+            return None, e
+
+    response, error = _responses.get(url, fetch)
+    if error:
+        raise error
+    return response
+
+def download(method, url, immutable=False):
+    """
+    Fetches a url through the on-disk cache. Immutable files are kept until evicted while
+    metadata and snapshots are revalidated with a conditional request once they're older
+    than the ttl, reusing the cached response if the server replies 304 Not Modified.
+    """
+    if _downloads is None or url.startswith('file:'):
+        return method(url)
+
+    # Avoid writing the repository credentials to disk
+    key = hashlib.sha1(url).hexdigest()
+    try:
+        entry = json.loads(_downloads.get(key) or 'null')
+    except ValueError:
+        entry = None
+
+    if entry and (immutable or time.time() - entry['timestamp'] < _ttl):
+        return entry['response']
+
+    validators = dict(entry.get('validators') or {}) if entry else {}
+    try:
+        response = method(url, validators=validators)
+    except urllib2.HTTPError as e:
+        if e.code != 304 or not entry:
+            raise
+        logging.debug('Reusing cached %s which has not been modified', url)
+        response, validators = entry['response'], entry.get('validators')
+
+    _downloads.put(key, json.dumps({'timestamp': time.time(), 'response': response, 'validators': validators}))
+    return response
+
+def enableCache(path, maxsize, ttl):
+    global _downloads, _ttl
+    _downloads = cache.DiskCache('maven downloads', os.path.join(path, 'maven'), maxsize) if path else None
+    _ttl = ttl
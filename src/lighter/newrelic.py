@@ -3,6 +3,9 @@ import traceback
 import urllib2
 import lighter.util as util
 
+# Seconds to wait for New Relic to respond
+_TIMEOUT = 10
+
 
 class NewRelic(object):
     """
@@ -38,7 +41,7 @@ class NewRelic(object):
                 'deployment[user]': 'Lighter'
             }
 
-            return util.xmlRequest(self._url, method='POST', data=data, headers=headers, contentType='application/x-www-form-urlencoded')
+            return util.xmlRequest(self._url, method='POST', data=data, headers=headers, contentType='application/x-www-form-urlencoded', timeout=_TIMEOUT)
 
         except urllib2.URLError as e:
             logging.warn(str(e))
@@ -3,6 +3,9 @@ import urllib2
 import lighter.util as util
 import json
 
+# Seconds to wait for Slack to respond
+_TIMEOUT = 10
+
 class Slack(object):
     def __init__(self, token, url=None, channels=[]):
         self._token = token
@@ -38,7 +41,7 @@ class Slack(object):
         try:
             url = self._url.rstrip('/') + endpoint
             logging.debug('Calling Slack endpoint %s', endpoint)
-            util.jsonRequest(url, data=data, method='POST', headers=headers)
+            util.jsonRequest(url, data=data, method='POST', headers=headers, timeout=_TIMEOUT)
         except urllib2.URLError as e:
             logging.warn(str(e))
             return {}
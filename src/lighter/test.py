@@ -11,6 +11,8 @@ from lighter.test.datadog_test import DatadogTest
 from lighter.test.graphite_test import GraphiteTest
 from lighter.test.docker_test import DockerTest
 from lighter.test.secretary_test import SecretaryTest
+from lighter.test.cache_test import CacheTest
+from lighter.test.connections_test import ConnectionsTest
 
 if __name__ == '__main__':
     suite = unittest.TestSuite()
@@ -26,6 +28,8 @@ if __name__ == '__main__':
     suite.addTest(unittest.makeSuite(GraphiteTest))
     suite.addTest(unittest.makeSuite(DockerTest))
     suite.addTest(unittest.makeSuite(SecretaryTest))
+    suite.addTest(unittest.makeSuite(CacheTest))
+    suite.addTest(unittest.makeSuite(ConnectionsTest))
 
     res = not unittest.TextTestRunner(verbosity=2).run(suite).wasSuccessful()
 
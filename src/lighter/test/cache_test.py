@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+import time
+import lighter.cache as cache
+
+class CacheTest(unittest.TestCase):
+    def testGet(self):
+        c = cache.MemoryCache('test')
+        self.assertEquals(1, c.get('a', lambda: 1))
+        self.assertEquals(1, c.get('a', lambda: 2))
+        self.assertEquals(2, c.get('b', lambda: 2))
+        self.assertEquals(1, c.hits)
+        self.assertEquals(2, c.misses)
+
+    def testGetConcurrent(self):
+        c = cache.MemoryCache('test')
+        calls = []
+        results = []
+
+        def factory():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'value'
+
+        threads = [threading.Thread(target=lambda: results.append(c.get('a', factory))) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(1, len(calls))
+        self.assertEquals(['value'] * 8, results)
+        self.assertEquals(1, c.misses)
+        self.assertEquals(7, c.hits)
+
+    def testGetFailure(self):
+        c = cache.MemoryCache('test')
+
+        def fail():
+            raise RuntimeError('failed')
+
+        with self.assertRaises(RuntimeError):
+            c.get('a', fail)
+        self.assertEquals(2, c.get('a', lambda: 2))
+
+    def testAddStatistics(self):
+        c = cache.MemoryCache('test')
+        before = cache.statistics()
+        c.get('a', lambda: 1)
+        c.get('a', lambda: 1)
+        counts = cache.countedSince(before)
+
+        c.clear()
+        cache.addStatistics(counts)
+        self.assertEquals(1, c.hits)
+        self.assertEquals(1, c.misses)
+
+    def testDiskCache(self):
+        path = tempfile.mkdtemp(prefix='lighter-cache_test')
+        try:
+            c = cache.DiskCache('test', path, 100)
+            self.assertEquals(None, c.get('a'))
+            c.put('a', 'x' * 40)
+            self.assertEquals('x' * 40, c.get('a'))
+
+            # Reopening the directory keeps the entries
+            c = cache.DiskCache('test', path, 100)
+            self.assertEquals('x' * 40, c.get('a'))
+
+            # The least recently used entries are evicted
+            os.utime(os.path.join(path, 'a'), (0, 0))
+            c.put('b', 'y' * 40)
+            c.put('c', 'z' * 40)
+            self.assertEquals(None, c.get('a'))
+            self.assertEquals('y' * 40, c.get('b'))
+            self.assertEquals('z' * 40, c.get('c'))
+        finally:
+            shutil.rmtree(path)
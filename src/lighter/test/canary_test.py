@@ -1,7 +1,9 @@
 import unittest
 from mock import patch
 import lighter.main as lighter
-from lighter.util import jsonRequest
+import json
+from StringIO import StringIO
+from lighter.util import jsonRequest, jsonItems
 
 class CanaryTest(unittest.TestCase):
     def testCanary(self):
@@ -49,13 +51,17 @@ class CanaryTest(unittest.TestCase):
         def wrapper(url, method='GET', data=None, *args, **kwargs):
             if url.startswith('file:') and method == 'GET':
                 return jsonRequest(url, data, *args, **kwargs)
-            if url == '%s/v2/apps?label=com.meltwater.lighter.canary.group%%3D%%3Dgeneric' % marathonurl and method == 'GET':
-                return {'apps': [canary2.config, canary3.config]}
             if url == '%s/v2/apps%s' % (marathonurl, canary3.config['id']) and method == 'DELETE':
                 self._deleted = True
                 return {}
             raise RuntimeError("Unexpected HTTP %s call to %s" % (method, url))
 
+        def stream(url, key, fields=None, *args, **kwargs):
+            if url == '%s/v2/apps?label=com.meltwater.lighter.canary.group%%3D%%3Dgeneric' % marathonurl:
+                return jsonItems(StringIO(json.dumps({'apps': [canary2.config, canary3.config]})), key, fields)
+            raise RuntimeError("Unexpected HTTP GET call to %s" % url)
+
         with patch('lighter.util.jsonRequest', wraps=wrapper):
-            lighter.cleanup_canaries(marathonurl, canaryGroup, [canary1, canary2])
-            self.assertTrue(self._deleted)
+            with patch('lighter.util.jsonStream', wraps=stream):
+                lighter.cleanup_canaries(marathonurl, canaryGroup, [canary1, canary2])
+                self.assertTrue(self._deleted)
@@ -15,8 +15,8 @@ class DatadogTest(unittest.TestCase):
             priority='normal',
             alert_type='info')
         self.assertEquals(mock_jsonRequest.call_count, 2)
-        mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/events?api_key=abc', data=ANY, method='POST')
-        mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/series?api_key=abc', data=ANY, method='POST')
+        mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/events?api_key=abc', data=ANY, method='POST', timeout=10)
+        mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/series?api_key=abc', data=ANY, method='POST', timeout=10)
 
     @patch('lighter.util.jsonRequest')
     def testNoApiKey(self, mock_jsonRequest):
@@ -66,7 +66,7 @@ class DatadogTest(unittest.TestCase):
     def testDefaultTags(self):
         with patch('lighter.util.jsonRequest', wraps=self._createJsonRequestWrapper()) as mock_jsonRequest:
             lighter.deploy('http://localhost:1/', filenames=['src/resources/yaml/integration/datadog-default-tags.yml'])
-            mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/events?api_key=abc', data=ANY, method='POST')
+            mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/events?api_key=abc', data=ANY, method='POST', timeout=10)
 
             expected = [
                 'environment:default',
@@ -78,7 +78,7 @@ class DatadogTest(unittest.TestCase):
     def testConfiguredTags(self):
         with patch('lighter.util.jsonRequest', wraps=self._createJsonRequestWrapper()) as mock_jsonRequest:
             lighter.deploy('http://localhost:1/', filenames=['src/resources/yaml/integration/datadog-config-tags.yml'])
-            mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/events?api_key=abc', data=ANY, method='POST')
+            mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/events?api_key=abc', data=ANY, method='POST', timeout=10)
 
             expected = [
                 'environment:default',
@@ -93,7 +93,7 @@ class DatadogTest(unittest.TestCase):
     def testDeploymentMetric(self):
         with patch('lighter.util.jsonRequest', wraps=self._createJsonRequestWrapper()) as mock_jsonRequest:
             lighter.deploy('http://localhost:1/', filenames=['src/resources/yaml/integration/datadog-config-tags.yml'])
-            mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/series?api_key=abc', data=ANY, method='POST')
+            mock_jsonRequest.assert_any_call('https://app.datadoghq.com/api/v1/series?api_key=abc', data=ANY, method='POST', timeout=10)
 
             tags = [
                 'environment:default',
@@ -1,10 +1,16 @@
 import unittest
 import os
+import json
 import urllib2
 import shutil
+import logging
+import threading
+import subprocess
 import tempfile
 from mock import patch, Mock
 import lighter.main as lighter
+import lighter.secretary as secretary
+import lighter.maven as maven
 from lighter.util import jsonRequest
 
 PROFILE_2 = 'src/resources/yaml/myprofile2.yml'
@@ -38,6 +44,217 @@ class DeployTest(unittest.TestCase):
         self.assertEquals(service.config['upgradeStrategy']['minimumHealthCapacity'], 0.0)
         self.assertEquals(service.config['upgradeStrategy']['maximumOverCapacity'], 0.0)
 
+    def testChecksumUnchanged(self):
+        # Apps deployed by earlier versions carry these checksums and mustn't be updated again
+        self.assertEquals('58c7dd73636b957fca251dde3c80b0a8', lighter.parse_service('src/resources/yaml/staging/myservice.yml').checksum)
+        self.assertEquals('91d53c48fc41388622079e6cc422bc20', lighter.parse_service('src/resources/yaml/staging/myservice-nomaven.yml').checksum)
+
+    def testParseSharedDocuments(self):
+        lighter._files.clear()
+        lighter._documents.clear()
+        lighter.parse_services(['src/resources/yaml/staging/myservice.yml', 'src/resources/yaml/staging/myservice-nomaven.yml'], profiles=[PROFILE_1])
+
+        # Both services share the same globals.yml files and profile which should only be parsed once,
+        # they're read again from the cache when each service is merged a second time
+        self.assertEquals(3, lighter._files.misses)
+        self.assertEquals(9, lighter._files.hits)
+        self.assertEquals(3, len(lighter._documents))
+
+    def testParseSharedGlobals(self):
+        lighter._chains.clear()
+        service1 = lighter.parse_service('src/resources/yaml/staging/myservice.yml')
+        directories = len(lighter._chains)
+        service2 = lighter.parse_service('src/resources/yaml/staging/myservice-nomaven.yml')
+
+        # Services in the same directory reuse the globals.yml files found for that directory
+        self.assertEquals(directories, len(lighter._chains))
+        self.assertEquals(1, lighter._chains.hits)
+        self.assertEquals(service1.document['facts'], service2.document['facts'])
+
+    def testGlobalsMergeOrder(self):
+        directory = tempfile.mkdtemp(prefix='lighter-deploy_test')
+        try:
+            os.makedirs(os.path.join(directory, 'nearest'))
+            with open(os.path.join(directory, 'globals.yml'), 'w') as fd:
+                fd.write("service:\n  args: ['p']\n")
+            with open(os.path.join(directory, 'nearest', 'globals.yml'), 'w') as fd:
+                fd.write("service:\n  args: ['a']\n")
+            with open(os.path.join(directory, 'nearest', 'service.yml'), 'w') as fd:
+                fd.write("service:\n  id: '/myservice'\n  args:\n    0: 'x'\n")
+
+            # The nearest globals.yml is merged into the service first, the parent's after that
+            service = lighter.parse_service(os.path.join(directory, 'nearest', 'service.yml'))
+            self.assertEquals(['p', 'x'], service.config['args'])
+        finally:
+            shutil.rmtree(directory)
+
+    def testParseServicesProcessBackend(self):
+        filenames = ['src/resources/yaml/staging/myservice.yml', 'src/resources/yaml/staging/myservice-non-docker.yml']
+        services = lighter.parse_services(filenames, profiles=[PROFILE_1], jobs=2, backend='process')
+        self.assertEquals(filenames, [service.filename for service in services])
+        self.assertEquals('/myproduct/myservice', services[0].config['id'])
+        self.assertTrue(isinstance(services[0].config['env']['DEPLOY_PUBLIC_KEY'], secretary.KeyValue))
+        self.assertEquals(lighter.parse_service(filenames[0], profiles=[PROFILE_1]).checksum, services[0].checksum)
+
+    def testParseServicesProcessBackendStatistics(self):
+        filenames = ['src/resources/yaml/staging/myservice.yml', 'src/resources/yaml/staging/myservice-non-docker.yml']
+        lookups = []
+        for backend in ('thread', 'process'):
+            lighter._files.clear()
+            lighter.parse_services(filenames, profiles=[PROFILE_1], jobs=2, backend=backend)
+            lookups.append(lighter._files.hits + lighter._files.misses)
+
+        # The files are read in the worker processes, which send back what they counted
+        self.assertEquals(0, len(lighter._files))
+        self.assertTrue(lookups[0] > 0)
+        self.assertEquals(lookups[0], lookups[1])
+
+    def testParseServicesProcessBackendError(self):
+        with self.assertRaises(RuntimeError):
+            lighter.parse_services(['src/resources/yaml/staging/myservice.yml', 'src/resources/yaml/staging/myservice-broken.yml'], backend='process')
+
+    def testParseServicesProcessBackendResolveError(self):
+        maven._responses.clear()
+        maven._indexes.clear()
+        error = urllib2.HTTPError('file:./maven-metadata.xml', 404, 'Not Found', {}, None)
+
+        # Raised by the resolving thread and handed to a worker process which can't unpickle it
+        try:
+            with patch('lighter.util.xmlRequest', side_effect=error):
+                with self.assertRaises(RuntimeError) as context:
+                    lighter.parse_services(['src/resources/yaml/integration/myservice-version-range.yml'], backend='process')
+        finally:
+            maven._responses.clear()
+            maven._indexes.clear()
+
+        self.assertTrue('com.meltwater:myservice:[1.0.0,1.1.0)' in str(context.exception))
+        self.assertTrue('HTTP Error 404' in str(context.exception))
+
+    def testRenderCache(self):
+        cachedir = tempfile.mkdtemp(prefix='lighter-deploy_test')
+        lighter.enable_render_cache(cachedir, 1024 * 1024)
+        try:
+            service1 = lighter.parse_service('src/resources/yaml/staging/myservice.yml')
+            with patch('lighter.maven.ArtifactResolver.fetch', side_effect=AssertionError('Should use cached render')):
+                service2 = lighter.parse_service('src/resources/yaml/staging/myservice.yml')
+
+            self.assertEquals('58c7dd73636b957fca251dde3c80b0a8', service1.checksum)
+            self.assertEquals(service1.checksum, service2.checksum)
+            self.assertEquals(service1.config['id'], service2.config['id'])
+            self.assertEquals(service1.document['hipchat'], service2.document['hipchat'])
+
+            # Deploy keys are generated again and never written to the cache
+            self.assertNotEqual(service1.config['env']['DEPLOY_PRIVATE_KEY'], service2.config['env']['DEPLOY_PRIVATE_KEY'])
+            self.assertTrue(isinstance(service2.config['env']['DEPLOY_PRIVATE_KEY'], secretary.KeyValue))
+            for filename in os.listdir(os.path.join(cachedir, 'renders')):
+                with open(os.path.join(cachedir, 'renders', filename)) as fd:
+                    content = fd.read()
+                    self.assertFalse('DEPLOY_PRIVATE_KEY' in content)
+
+                    # Notification tokens are merged again instead of being cached
+                    self.assertFalse('hipchat' in json.loads(content)['document'])
+        finally:
+            lighter.enable_render_cache(None, 0)
+            shutil.rmtree(cachedir)
+
+    def testRenderCacheLoadedOnce(self):
+        cachedir = tempfile.mkdtemp(prefix='lighter-deploy_test')
+        lighter.enable_render_cache(cachedir, 1024 * 1024)
+        try:
+            filenames = ['src/resources/yaml/staging/myservice.yml', 'src/resources/yaml/staging/myservice-nomaven.yml']
+            services1 = lighter.parse_services(filenames)
+            with patch('lighter.main.load_render', wraps=lighter.load_render) as mock_load:
+                services2 = lighter.parse_services(filenames)
+
+            # The render found while collecting the coordinates is reused for substituting
+            self.assertEquals(2, mock_load.call_count)
+            self.assertEquals([service.checksum for service in services1], [service.checksum for service in services2])
+        finally:
+            lighter.enable_render_cache(None, 0)
+            shutil.rmtree(cachedir)
+
+    def testRenderCacheEnvironment(self):
+        cachedir = tempfile.mkdtemp(prefix='lighter-deploy_test')
+        lighter.enable_render_cache(cachedir, 1024 * 1024)
+        try:
+            os.environ['VERSION'] = '1.0.0'
+            os.environ['DATABASE'] = 'hostname:3306'
+            os.environ['RABBITMQ_URL'] = 'amqp://hostname:5672/%2F'
+            lighter.parse_service('src/resources/yaml/staging/myservice-env-maven.yml')
+
+            # Only hashes of the environment variables and the repository url are cached
+            for filename in os.listdir(os.path.join(cachedir, 'renders')):
+                with open(os.path.join(cachedir, 'renders', filename)) as fd:
+                    content = fd.read()
+                    self.assertEquals(40, len(json.loads(content)['dependencies']['env']['env.DATABASE']))
+                    self.assertFalse('hostname:3306' in content)
+                    self.assertFalse('hostname:5672' in content)
+                    self.assertFalse('src/resources/repository' in content)
+
+            # The values are taken from the environment when the cached render is used
+            with patch('lighter.maven.ArtifactResolver.fetch', side_effect=AssertionError('Should use cached render')):
+                service = lighter.parse_service('src/resources/yaml/staging/myservice-env-maven.yml')
+            self.assertEquals('hostname:3306', service.config['env']['DATABASE'])
+            self.assertEquals('amqp://hostname:5672/%2F', service.config['env']['RABBITMQ_URL'])
+            self.assertEquals('file:./src/resources/repository/', service.document['maven']['repository'])
+
+            os.environ['DATABASE'] = 'otherhost:3306'
+            service = lighter.parse_service('src/resources/yaml/staging/myservice-env-maven.yml')
+            self.assertEquals('otherhost:3306', service.config['env']['DATABASE'])
+        finally:
+            lighter.enable_render_cache(None, 0)
+            shutil.rmtree(cachedir)
+
+    def testChangedServices(self):
+        repository = os.path.realpath(tempfile.mkdtemp(prefix='lighter-deploy_test'))
+
+        def write(filename, content):
+            path = os.path.join(repository, filename)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fd:
+                fd.write(content)
+
+        def git(*args):
+            subprocess.check_output(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args), cwd=repository)
+
+        try:
+            for filename in ['globals.yml', 'a/globals.yml', 'a/service1.yml', 'a/b/service2.yml', 'c/service3.yml', 'profile.yml']:
+                write(filename, 'variables: {}\n')
+            git('init', '-q')
+            git('add', '.')
+            git('commit', '-q', '-m', 'initial')
+
+            filenames = [os.path.join(repository, filename) for filename in ['a/service1.yml', 'a/b/service2.yml', 'c/service3.yml']]
+            profiles = [os.path.join(repository, 'profile.yml')]
+            self.assertEquals([], lighter.changed_services(filenames, profiles, 'HEAD'))
+
+            write('a/b/service2.yml', 'variables: {a: 1}\n')
+            self.assertEquals(filenames[1:2], lighter.changed_services(filenames, profiles, 'HEAD'))
+
+            write('a/globals.yml', 'variables: {a: 1}\n')
+            self.assertEquals(filenames[0:2], lighter.changed_services(filenames, profiles, 'HEAD'))
+
+            git('commit', '-q', '-a', '-m', 'second')
+            write('c/globals.yml', 'variables: {a: 1}\n')
+            self.assertEquals(filenames[2:3], lighter.changed_services(filenames, profiles, 'HEAD'))
+            self.assertEquals(filenames, lighter.changed_services(filenames, profiles, 'HEAD~1'))
+
+            os.remove(os.path.join(repository, 'globals.yml'))
+            self.assertEquals(filenames, lighter.changed_services(filenames, profiles, 'HEAD'))
+
+            git('checkout', '-q', '--', 'globals.yml')
+            write('profile.yml', 'variables: {a: 1}\n')
+            self.assertEquals(filenames, lighter.changed_services(filenames, profiles, 'HEAD'))
+
+            # Moving a globals.yml affects the services below its old location
+            git('checkout', '-q', '--', 'profile.yml')
+            os.remove(os.path.join(repository, 'c/globals.yml'))
+            git('mv', 'a/globals.yml', 'old-globals.yml')
+            self.assertEquals(filenames[0:2], lighter.changed_services(filenames, profiles, 'HEAD'))
+        finally:
+            shutil.rmtree(repository)
+
     def testParseNonDockerService(self):
         service = lighter.parse_service('src/resources/yaml/staging/myservice-non-docker.yml')
         self.assertEquals(service.config['id'], '/myservice/hello-play')
@@ -154,6 +371,85 @@ class DeployTest(unittest.TestCase):
                 lighter.deploy(marathonurl=None, filenames=['src/resources/yaml/staging/myservice.yml'])
             self.assertEqual("No Marathon URL defined for service src/resources/yaml/staging/myservice.yml", cm.exception.message)
 
+    def testDeployConcurrency(self):
+        filenames = ['src/resources/yaml/integration/myservice.yml', 'src/resources/yaml/integration/myservice-canary1.yml',
+                     'src/resources/yaml/integration/myservice-canary2.yml']
+        deployed = []
+
+        def wrapper(url, method='GET', data=None, *args, **kwargs):
+            if url.startswith('file:'):
+                return jsonRequest(url, data, *args, **kwargs)
+            if method == 'GET':
+                return {'app': {}}
+            if method == 'PUT':
+                deployed.append(url)
+                return {}
+
+        with patch('lighter.util.jsonRequest', wraps=wrapper):
+            services = lighter.deploy('http://localhost:1/', filenames=filenames, concurrency=4)
+        self.assertEquals(3, len(services))
+        self.assertEquals(3, len(deployed))
+
+    def testDeployConcurrencyErrors(self):
+        filenames = ['src/resources/yaml/integration/myservice.yml', 'src/resources/yaml/integration/myservice-canary1.yml',
+                     'src/resources/yaml/integration/myservice-canary2.yml']
+        deployed = []
+
+        def wrapper(url, method='GET', data=None, *args, **kwargs):
+            if url.startswith('file:'):
+                return jsonRequest(url, data, *args, **kwargs)
+            if method == 'GET':
+                return {'app': {}}
+            if method == 'PUT':
+                with lock:
+                    deployed.append(url)
+                    if len(deployed) > 1:
+                        raise urllib2.URLError('Connection refused')
+                return {}
+
+        # The other services are deployed and the failures reported together
+        lock = threading.Lock()
+        with patch('lighter.util.jsonRequest', wraps=wrapper):
+            with self.assertRaises(RuntimeError) as cm:
+                lighter.deploy('http://localhost:1/', filenames=filenames, concurrency=4)
+        self.assertEquals(3, len(deployed))
+        self.assertTrue(cm.exception.message.startswith('Failed to deploy 2 of 3 services'))
+        self.assertEquals(2, cm.exception.message.count('(<urlopen error Connection refused>)'))
+
+    def testServiceLogs(self):
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        handler = Handler()
+        logging.getLogger().addHandler(handler)
+        try:
+            with lighter.ServiceLogs() as logs:
+                def worker(name):
+                    logs.capture()
+                    try:
+                        logging.warn('%s started', name)
+                        started.wait()
+                        logging.warn('%s done', name)
+                    finally:
+                        logs.flush()
+
+                started = threading.Event()
+                threads = [threading.Thread(target=worker, args=(name,)) for name in ['a', 'b']]
+                for thread in threads:
+                    thread.start()
+                logging.warn('not captured')
+                started.set()
+                for thread in threads:
+                    thread.join()
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+        self.assertEquals('not captured', records[0])
+        self.assertEquals(sorted([['a started', 'a done'], ['b started', 'b done']]), sorted([records[1:3], records[3:5]]))
+
     def testUnresolvedVariable(self):
         service_yaml = 'src/resources/yaml/integration/myservice-unresolved-variable.yml'
         try:
@@ -224,3 +520,19 @@ class DeployTest(unittest.TestCase):
             self.assertTrue(os.path.exists('%s/src/resources/yaml/staging/myservice-non-docker.yml.json' % targetdir))
         finally:
             shutil.rmtree(targetdir)
+
+    def testVerifyWritesServices(self):
+        targetdir = tempfile.mkdtemp(prefix='lighter-deploy_test')
+        try:
+            with patch('os.makedirs', wraps=os.makedirs) as makedirs:
+                lighter.verify(['src/resources/yaml/staging/myservice.yml', 'src/resources/yaml/staging/myservice-non-docker.yml'], targetdir=targetdir)
+                directory = os.path.join(targetdir, 'src/resources/yaml/staging')
+                self.assertEquals(1, len([call for call in makedirs.call_args_list if call[0][0] == directory]))
+            self.assertTrue(os.path.exists('%s/src/resources/yaml/staging/myservice.yml.json' % targetdir))
+            self.assertTrue(os.path.exists('%s/src/resources/yaml/staging/myservice-non-docker.yml.json' % targetdir))
+        finally:
+            shutil.rmtree(targetdir)
+
+    def testVerifySecrets(self):
+        with self.assertRaises(RuntimeError):
+            lighter.verify(['src/resources/yaml/staging/myservice-password.yml'], enforceSecrets=True)
@@ -44,7 +44,7 @@ class GraphiteTest(unittest.TestCase):
                 'tags':
                     'environment:default service:/myproduct/myservice somekey:someval anotherkey:anotherval ' +
                     'justakey es_ca_pe trimwhitespace source:lighter type:change',
-                'when': 1477507464})
+                'when': 1477507464}, timeout=10)
 
         self.assertEquals(1, mock_sock.connect.call_count)
         mock_sock.connect.assert_called_with(('localhost', 2003))
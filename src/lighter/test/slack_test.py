@@ -9,10 +9,10 @@ class SlackTest(unittest.TestCase):
         Slack(token='abc', channels=['123', '123', '456']).notify({'text': "Test message"})
         mock_jsonRequest.assert_any_call('https://slack.com/api/chat.postMessage', data=ANY, method='POST', headers={
             'Content-type': 'application/json; charset=UTF-8', 'Authorization': 'Bearer abc'
-        })
+        }, timeout=10)
         mock_jsonRequest.assert_any_call('https://slack.com/api/chat.postMessage', data=ANY, method='POST', headers={
             'Content-type': 'application/json; charset=UTF-8', 'Authorization': 'Bearer abc'
-        })
+        }, timeout=10)
         self.assertEquals(mock_jsonRequest.call_count, 2)
 
     @patch('lighter.util.jsonRequest')
@@ -1,6 +1,13 @@
 import os
 import sys
+import ssl
+import time
+import random
+import socket
+import httplib
 import logging
+import threading
+import email.utils
 import re
 import urllib
 import urllib2
@@ -8,8 +15,38 @@ import urlparse
 import base64
 import json
 import hashlib
-import xml.dom.minidom as minidom
+import xml.etree.cElementTree as ElementTree
 from copy import copy
+import lighter.connections as connections
+
+_VARIABLE_RE = re.compile(r"(?<!%)%\{(\s*[\w\.]+\s*)\}")
+_ESCAPED_VARIABLE_RE = re.compile(r"%%\{(\s*[\w\.]+\s*)\}")
+_templates = {}
+_SKIPPED = object()
+_JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+_JSON_CHUNK_SIZE = 64 * 1024
+
+# Responses that are retried, and where a Retry-After header is honored
+_RETRY_STATUS = set([429, 502, 503, 504])
+_RETRY_AFTER_STATUS = set([429, 503])
+
+# Number of retries and their initial and maximum delay in seconds, configured with --retries
+_retries = 3
+_retryDelay = 0.5
+_retryMaxDelay = 30
+
+# Circuit breakers keyed by scheme and host
+_breakers = {}
+_breakersLock = threading.Lock()
+
+# Time when the whole run must complete, configured with --deadline
+_deadline = None
+
+# Requests taking longer than this many seconds are logged
+_SLOW_REQUEST = 5
+
+_DURATION_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([smh]?)\s*$')
+_DURATION_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600}
 
 def hashable(a):
     return not isinstance(a, (dict, list, tuple))
@@ -25,41 +62,56 @@ def toList(a):
     return [a] if (a is not None) else []
 
 def merge(aval, bval, path=''):
-    aval = copy(aval)
-
+    """
+    Deep merges bval into aval without modifying either of them. The dicts that are merged
+    and the dicts taken from aval are copied like they always were since the key order of
+    the copies, and so the config checksums, depend on it. Everything below them is shared
+    with the inputs rather than passed through merge() again.
+    """
     if isinstance(aval, (list, tuple)) and isinstance(bval, (dict)):
         # Override and deep merge specific list items
-        aval = toList(aval)
-        for key, value in bval.items():
-            if int(key) < 0 or int(key) >= len(aval):
+        result = list(aval)
+        for key, value in bval.iteritems():
+            if int(key) < 0 or int(key) >= len(result):
                 raise IndexError("The given list override index %s[%d] doesn't exist" % (path.lstrip('.'), int(key)))
-            aval[int(key)] = merge(aval[int(key)], value, '%s[%d]' % (path, int(key)))
-    elif isinstance(aval, dict) and isinstance(bval, dict):
-        # Deep merge dicts
+            result[int(key)] = merge(result[int(key)], value, '%s[%d]' % (path, int(key)))
+        return result
+
+    if isinstance(aval, dict) and isinstance(bval, dict):
+        # Deep merge dicts, new keys are added in the order of the set of all keys
+        result = copy(aval)
         for key in set(aval.keys() + bval.keys()):
-            asubval = aval.get(key)
             bsubval = bval.get(key)
-            aval[key] = merge(asubval, bsubval, '%s.%s' % (path, key))
-    elif isinstance(aval, (list, tuple)) and isinstance(bval, (list, tuple)):
+            if bsubval is None:
+                asubval = aval.get(key)
+                result[key] = copy(asubval) if isinstance(asubval, dict) else asubval
+            else:
+                result[key] = merge(aval.get(key), bsubval, '%s.%s' % (path, key))
+        return result
+
+    if isinstance(aval, (list, tuple)) and isinstance(bval, (list, tuple)):
         # Append lists
-        aval = toList(aval) + toList(bval)
-    elif bval is not None:
-        # Scalar values
-        aval = bval
+        return list(aval) + list(bval)
 
-    return aval
+    # Scalar values
+    if bval is not None:
+        return bval
+    return copy(aval) if isinstance(aval, dict) else aval
 
 class FixedVariables(object):
-    def __init__(self, variables):
+    def __init__(self, variables, popped=()):
         self._variables = variables
+        self._popped = set(popped)
 
     def clone(self):
-        return FixedVariables(copy(self._variables))
+        # Share the variables and only copy the names popped so far
+        return FixedVariables(self._variables, self._popped)
 
     def pop(self, name):
-        if name not in self._variables:
+        if name not in self._variables or name in self._popped:
             raise KeyError('Variable %%{%s} not found' % name)
-        return self._variables.pop(name)
+        self._popped.add(name)
+        return self._variables[name]
 
 class EnvironmentVariables(object):
     def __init__(self, wrappedResolver):
@@ -73,6 +125,30 @@ class EnvironmentVariables(object):
             return os.environ[name[4:]]
         return self._wrappedResolver.pop(name)
 
+class TrackingVariables(object):
+    """
+    Records the values that the selected variables resolve to, or None for missing variables
+    """
+    def __init__(self, wrappedResolver, condition, values=None):
+        self._wrappedResolver = wrappedResolver
+        self._condition = condition
+        self.values = values if values is not None else {}
+
+    def clone(self):
+        return TrackingVariables(self._wrappedResolver.clone(), self._condition, self.values)
+
+    def pop(self, name):
+        try:
+            value = self._wrappedResolver.pop(name)
+        except KeyError:
+            if self._condition(name):
+                self.values[name] = None
+            raise
+
+        if self._condition(name):
+            self.values[name] = value
+        return value
+
 class Value(object):
     """
     Allows to override the test when service.config is compared
@@ -121,41 +197,114 @@ def checksum(value):
 def toJson(value, *args, **kwargs):
     return json.dumps(value, cls=ValueEncoder, *args, **kwargs)
 
-def replace(template, variables, raiseError=True, escapeVar=True):
-    result = copy(template)
+class Template(object):
+    """
+    String split once into literal parts and %{variable} references
+    """
+    def __init__(self, text):
+        self.tokens = []
+        self.whole = None
+
+        position = 0
+        for match in _VARIABLE_RE.finditer(text):
+            if match.start() > position:
+                self.tokens.append(text[position:match.start()])
+            self.tokens.append(Reference(match.group(1).strip(), match.group(0)))
+            position = match.end()
+
+        if self.tokens and position < len(text):
+            self.tokens.append(text[position:])
+
+        # A string consisting of exactly one variable is replaced by its value and type
+        if len(self.tokens) == 1 and text == '%%{%s}' % self.tokens[0].name:
+            self.whole = self.tokens[0]
+
+    @staticmethod
+    def compile(text):
+        template = _templates.get(text)
+        if template is None:
+            if len(_templates) >= 100000:
+                _templates.clear()
+            template = _templates[text] = Template(text)
+        return template
+
+class Reference(object):
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+
+class Substitution(object):
+    """
+    Expands the variables of a single string, each variable is popped from the resolver
+    at most once and variables may expand recursively into other variables.
+    """
+    def __init__(self, variables, raiseError):
+        self._variables = variables
+        self._raiseError = raiseError
+        self._remaining = None
+        self._values = {}
+        self._active = set()
+
+    def expand(self, text):
+        template = Template.compile(text)
+        if not template.tokens:
+            return text
+
+        if template.whole is not None:
+            return self._resolve(template.whole, text)
+
+        parts = []
+        for token in template.tokens:
+            if isinstance(token, Reference):
+                token = unicode(self._resolve(token, token.text))
+            parts.append(token)
+        return u''.join(parts)
+
+    def _resolve(self, reference, default):
+        name = reference.name
+        if name in self._active:
+            return self._missing(KeyError('Variable %%{%s} not found' % name), default)
+
+        if name not in self._values:
+            if self._remaining is None:
+                self._remaining = self._variables.clone()
+
+            try:
+                self._values[name] = self._remaining.pop(name)
+            except KeyError as e:
+                return self._missing(e, default)
+
+        value = self._values[name]
+        if isinstance(value, (str, unicode)):
+            self._active.add(name)
+            try:
+                value = self.expand(value)
+            finally:
+                self._active.remove(name)
+        return value
 
-    if isinstance(result, dict):
-        for key, value in result.items():
+    def _missing(self, e, default):
+        if self._raiseError:
+            raise KeyError(e.message), None, sys.exc_info()[2]
+        return default
+
+def replace(template, variables, raiseError=True, escapeVar=True):
+    if isinstance(template, dict):
+        # Copy and assign rather than build a new dict, which keeps the key order and so the config checksums
+        result = copy(template)
+        for key, value in result.iteritems():
             result[key] = replace(value, variables, raiseError, escapeVar)
-    elif isinstance(result, (list, tuple)):
-        result = [replace(elem, variables, raiseError, escapeVar) for elem in result]
-    else:
-        if isinstance(result, (str, unicode)):
-            remaining = variables.clone()
-            replacements = 1
+        return result
+    if isinstance(template, (list, tuple)):
+        return [replace(elem, variables, raiseError, escapeVar) for elem in template]
+    if not isinstance(template, (str, unicode)):
+        return copy(template)
 
-            while replacements > 0 and isinstance(result, (str, unicode)):
-                replacements = 0
-                names = re.findall(r"(?<!%)%\{(\s*[\w\.]+\s*)\}", result)
+    result = Substitution(variables, raiseError).expand(template)
 
-                if not names:
-                    break
-                for name in set([name.strip() for name in names]):
-                    try:
-                        value = remaining.pop(name)
-                        if result == '%%{%s}' % name:
-                            # This preserves the type of the value
-                            result = value
-                        else:
-                            result = re.sub('%{\s*' + re.escape(name) + '\s*}', unicode(value), result)
-                        replacements += 1
-                    except KeyError as e:
-                        if raiseError:
-                            raise KeyError(e.message), None, sys.exc_info()[2]
-
-            # Replace double %%{foo} with %{foo}
-            if escapeVar and isinstance(result, (str, unicode)):
-                result = re.sub(r"%%\{(\s*[\w\.]+\s*)\}", "%{\\1}", result)
+    # Replace double %%{foo} with %{foo}
+    if escapeVar and isinstance(result, (str, unicode)) and '%%{' in result:
+        result = _ESCAPED_VARIABLE_RE.sub("%{\\1}", result)
 
     return result
 
@@ -211,51 +360,399 @@ def buildRequest(url, data=None, headers={}, method='GET', contentType='applicat
 
 def openRequest(request, timeout=None):
     cafile = os.path.join(sys._MEIPASS, 'requests', 'cacert.pem') if getattr(sys, 'frozen', None) else None
-    return urllib2.urlopen(request, cafile=cafile, timeout=timeout)
+    return connections.openRequest(request, timeout=timeout, cafile=cafile)
+
+def sendRequest(request, timeout=None, retry=None):
+    """
+    Opens a request, retrying connection errors and 429/502/503/504 responses with exponential
+    backoff and jitter. Only idempotent methods are retried unless retry is given. Hosts that keep
+    failing are not called for a while but fail fast through a circuit breaker. The timeout of each
+    attempt is shortened so the request doesn't run past the deadline of the run.
+    """
+    if request.get_type() not in ('http', 'https'):
+        return openRequest(request, timeout=timeout)
+
+    retry = request.get_method() in connections.IDEMPOTENT_METHODS if retry is None else retry
+    parsed = urlparse.urlparse(request.get_full_url())
+    host = '%s://%s' % (parsed.scheme, parsed.netloc.rsplit('@', 1)[-1])
+    url = logUrl(request.get_full_url())
+    breaker = getBreaker(host)
+
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise urllib2.URLError('Not calling %s which failed %d times in a row' % (host, breaker.failures))
+
+        delay = None
+        remaining = requestTimeout(timeout)
+        started = time.time()
+        try:
+            response = openRequest(request, timeout=remaining)
+            breaker.success()
+            return response
+        except urllib2.HTTPError as e:
+            if e.code in _RETRY_STATUS and e.code != 429:
+                breaker.failure()
+            else:
+                breaker.success()
+
+            if not retry or attempt >= _retries or e.code not in _RETRY_STATUS:
+                raise
+            if e.code in _RETRY_AFTER_STATUS:
+                delay = retryAfter(e.info())
+            error = e
+        except (urllib2.URLError, socket.error, httplib.HTTPException) as e:
+            breaker.failure()
+
+            # Protocol mismatches won't go away by trying again
+            if not retry or attempt >= _retries or isinstance(getattr(e, 'reason', e), ssl.SSLError):
+                raise
+            error = e
+        finally:
+            elapsed = time.time() - started
+            if elapsed >= _SLOW_REQUEST:
+                logging.warn('Slow response from %s %s after %.1f seconds', request.get_method(), url, elapsed)
+
+        if delay is None:
+            delay = random.uniform(0, min(_retryMaxDelay, _retryDelay * 2 ** attempt))
+        attempt += 1
+
+        # Give up rather than wait past the deadline
+        if _deadline is not None and time.time() + delay >= _deadline:
+            raise error
+
+        logging.warn('Retrying %s %s in %.1f seconds (%d of %d) after %s', request.get_method(), url, delay, attempt, _retries, error)
+        time.sleep(delay)
+
+def logUrl(url):
+    """
+    Returns the scheme, host and path of a url, leaving out the user info and query which may hold credentials
+    """
+    parsed = urlparse.urlparse(url)
+    return '%s://%s%s' % (parsed.scheme, parsed.netloc.rsplit('@', 1)[-1], parsed.path)
+
+def requestTimeout(timeout):
+    """
+    Returns the timeout of a request shortened to the time left until the deadline
+    """
+    if _deadline is None:
+        return timeout
+
+    remaining = _deadline - time.time()
+    if remaining <= 0:
+        raise urllib2.URLError('Deadline exceeded')
+    return min(timeout, remaining) if timeout is not None else remaining
+
+def parseDuration(value):
+    """
+    Parses a duration like 90, 90s, 10m or 1.5h into seconds
+    """
+    match = _DURATION_RE.match(str(value))
+    if not match:
+        raise ValueError('%s is not a valid duration' % value)
+    return float(match.group(1)) * _DURATION_UNITS[match.group(2)]
+
+def enableDeadline(seconds):
+    global _deadline
+    _deadline = time.time() + seconds if seconds else None
+
+def retryAfter(headers):
+    """
+    Returns the delay in seconds requested by a Retry-After header, at most _retryMaxDelay
+    """
+    value = headers.getheader('Retry-After') if hasattr(headers, 'getheader') else None
+    if not value:
+        return None
+
+    if value.strip().isdigit():
+        delay = int(value)
+    else:
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            return None
+        delay = email.utils.mktime_tz(parsed) - time.time()
+
+    return min(max(delay, 0), _retryMaxDelay)
 
-def jsonRequest(url, data=None, headers={}, method='GET', contentType='application/json', timeout=None):
+class CircuitBreaker(object):
+    """
+    Opens after a number of consecutive failures, after which calls fail fast until the timeout
+    has passed. A single call is then let through to find out if the host has recovered.
+    """
+    def __init__(self, threshold=5, timeout=30):
+        self.failures = 0
+        self._threshold = threshold
+        self._timeout = timeout
+        self._until = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.failures < self._threshold:
+                return True
+
+            now = time.time()
+            if now < self._until:
+                return False
+
+            # Let one call through and keep failing fast until it completes
+            self._until = now + self._timeout
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self._threshold:
+                self._until = time.time() + self._timeout
+
+def getBreaker(host):
+    with _breakersLock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker()
+        return breaker
+
+def enableRetries(retries):
+    global _retries
+    _retries = retries
+    with _breakersLock:
+        _breakers.clear()
+
+def conditionalHeaders(headers, validators):
+    """
+    Adds the If-None-Match and If-Modified-Since headers for a previously seen response
+    """
+    if not validators:
+        return headers
+
+    headers = copy(headers)
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('lastModified'):
+        headers['If-Modified-Since'] = validators['lastModified']
+    return headers
+
+def updateValidators(response, validators):
+    """
+    Replaces the validators with the ETag and Last-Modified headers of a response
+    """
+    if validators is not None:
+        validators.clear()
+        for name, header in (('etag', 'ETag'), ('lastModified', 'Last-Modified')):
+            value = response.info().getheader(header)
+            if value:
+                validators[name] = value
+
+def jsonRequest(url, data=None, headers={}, method='GET', contentType='application/json', timeout=None, validators=None, retry=None):
+    """
+    Fetches and decodes a json document. Given a dict of validators from an earlier response the
+    request is made conditional, and an unchanged document raises an HTTPError with code 304.
+    Failures are retried as described for sendRequest() unless retry is False.
+    """
+    return json.loads(jsonText(url, data, headers, method, contentType, timeout, validators, retry))
+
+def jsonText(url, data=None, headers={}, method='GET', contentType='application/json', timeout=None, validators=None, retry=None):
+    """
+    Fetches a json document like jsonRequest() but returns it undecoded, or '{}' if the response
+    isn't json. Decoding the same text always gives dicts that iterate in the same order.
+    """
     logging.debug('%sing url %s', method, url)
-    response = openRequest(buildRequest(url, data, headers, method, contentType), timeout=timeout)
+    response = sendRequest(buildRequest(url, data, conditionalHeaders(headers, validators), method, contentType), timeout=timeout, retry=retry)
     content = response.read()
     logging.debug('Got response HTTP ' + str(response.getcode()) + ': ' + str(content)[0:250])
+    updateValidators(response, validators)
 
     contenttype = response.info().gettype()
     if contenttype == 'application/json' or contenttype == 'text/json' or contenttype == 'text/plain' or 'docker.distribution.manifest' in contenttype:
-        return json.loads(content)
+        return content
 
     logging.debug('Content-Type %s is not json %s', response.info().gettype(), content)
-    return {}
+    return '{}'
 
-def xmlRequest(url, data=None, headers={}, method='GET', contentType='application/json', timeout=None):
+def headRequest(url, headers={}, timeout=None, retry=None):
+    """
+    Returns the response headers of a url without fetching its content
+    """
+    logging.debug('HEADing url %s', url)
+    response = sendRequest(buildRequest(url, headers=headers, method='HEAD'), timeout=timeout, retry=retry)
+    response.close()
+    return response.info()
+
+def xmlRequest(url, data=None, headers={}, method='GET', contentType='application/json', timeout=None, validators=None, paths=None):
+    """
+    Fetches and transforms an xml document, conditional requests work like for jsonRequest()
+    and the paths select parts of the document as described for xmlParse()
+    """
     logging.debug('%sing url %s', method, url)
-    response = openRequest(buildRequest(url, data, headers, method, contentType), timeout=timeout).read()
-    return xmlTransform(minidom.parseString(response).documentElement)
-
-def xmlText(nodelist):
-    result = ''
-    for node in nodelist:
-        if node.nodeType == node.TEXT_NODE:
-            result += node.data
-        else:
-            result += xmlText(node.childNodes)
+    response = sendRequest(buildRequest(url, data, conditionalHeaders(headers, validators), method, contentType), timeout=timeout)
+    updateValidators(response, validators)
+    return xmlParse(response, paths)
+
+def xmlParse(source, paths=None):
+    """
+    Incrementally transforms an xml document read from a file-like object into nested dicts
+    keyed by element name. Repeated elements become lists and leaf elements become their text.
+    Given a list of slash separated paths like 'versioning/versions/version', relative to the
+    document element, only the elements along and below those paths are kept.
+    """
+    # Tree of selected element names where None keeps the whole subtree
+    selected = None
+    if paths is not None:
+        selected = {}
+        for path in paths:
+            node = selected
+            names = path.split('/')
+            for name in names[0:-1]:
+                node = node.setdefault(name, {})
+                if node is None:
+                    break
+            else:
+                node[names[-1]] = None
+
+    # Each frame holds the element name, child values, whether any child was seen and the selection
+    frames = []
+    result = None
+
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            name = _xmlName(elem.tag)
+            node = selected
+            if frames:
+                parent = frames[-1]
+                parent[2] = True
+                node = parent[3].get(name, _SKIPPED) if isinstance(parent[3], dict) else parent[3]
+            frames.append([name, {}, False, node])
+            continue
+
+        name, children, haschildren, node = frames.pop()
+        if node is not _SKIPPED:
+            value = children if haschildren else (elem.text or '')
+            if frames:
+                siblings = frames[-1][1]
+                item = siblings.get(name)
+                if item is None:
+                    item = value
+                elif isinstance(item, list):
+                    item.append(value)
+                else:
+                    item = [item, value]
+                siblings[name] = item
+            else:
+                result = value
+
+        elem.clear()
+
     return result
 
-def xmlTransform(node):
-    result = {}
-
-    for child in node.childNodes:
-        if child.nodeType != node.TEXT_NODE:
-            value = xmlTransform(child)
-            item = result.get(child.tagName)
-            if item is None:
-                item = value
-            elif isinstance(item, list):
-                item.append(value)
+def _xmlName(tag):
+    # Strip the {namespace} prefix from element names
+    return tag[tag.index('}') + 1:] if tag.startswith('{') else tag
+
+def jsonStream(url, key, fields=None, headers={}, timeout=None):
+    """
+    Fetches a json document and yields the items of the array under a top level key one at a
+    time, like the apps of a Marathon /v2/apps listing, without holding the whole document in
+    memory. Given a list of fields only those fields are kept of each item.
+    """
+    logging.debug('GETing url %s', url)
+    response = sendRequest(buildRequest(url, headers=headers), timeout=timeout)
+    try:
+        contenttype = response.info().gettype()
+        if contenttype != 'application/json' and contenttype != 'text/json' and contenttype != 'text/plain':
+            logging.debug('Content-Type %s is not json', contenttype)
+            return
+
+        for item in jsonItems(response, key, fields):
+            yield item
+    finally:
+        response.close()
+
+def jsonItems(fp, key, fields=None):
+    """
+    Incrementally decodes the items of the array under a top level key of a json document read
+    from a file-like object. Other top level members are decoded and skipped one at a time.
+    """
+    reader = _JsonReader(fp)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
             else:
-                item = [item, value]
-            result[child.tagName] = item
+                while True:
+                    item = reader.value()
+                    if fields is not None and isinstance(item, dict):
+                        item = dict((field, item[field]) for field in fields if field in item)
+                    yield item
+
+                    if reader.expect(',]') == ']':
+                        break
+        else:
+            reader.value()
+
+        if reader.expect(',}') == '}':
+            return
 
-    return result or xmlText(node.childNodes)
+class _JsonReader(object):
+    """
+    Reads json values one at a time from a file-like object, buffering only the current value
+    """
+    def __init__(self, fp):
+        self._fp = fp
+        self._buffer = ''
+        self._pos = 0
+        self._decoder = json.JSONDecoder()
+
+    def peek(self):
+        # Returns the next character that isn't whitespace
+        while True:
+            self._pos = _JSON_WHITESPACE_RE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError('Unexpected end of json document')
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise ValueError("Expected one of '%s' but got '%s' in json document" % (chars, char))
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            error = None
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self._buffer):
+                    self._pos = end
+                    return value
+            except ValueError as e:
+                error = e
+
+            if not self._fill():
+                raise error or ValueError('Unexpected end of json document')
+
+    def _fill(self):
+        chunk = self._fp.read(_JSON_CHUNK_SIZE)
+        if not chunk:
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
 
 def rget(root, *args):
     node = root